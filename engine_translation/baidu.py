@@ -1,49 +1,111 @@
 from random import randint
 from hashlib import md5
-from http.client import HTTPConnection
+from http.client import HTTPConnection, HTTPException
 import json
+import queue
 from urllib import parse
 
+
+class BaiduError(Exception):
+    """
+    百度翻译接口返回的错误，error_code 为接口的错误码
+    """
+    def __init__(self,message,error_code) -> None:
+        super().__init__(message)
+        self.error_code = error_code
+
+
 class Baidu:
-    def __init__(self,appid,secretKey) -> None:
+    # 界面上的语言名到百度翻译语言代码
+    LANGUAGE_CODES = {
+        "中文": "zh", "繁体中文": "cht", "日语": "jp", "英语": "en", "韩语": "kor",
+        "法语": "fra", "西班牙语": "spa", "德语": "de", "俄语": "ru",
+    }
+
+    def __init__(self,appid,secretKey,qps=1,max_concurrency=2) -> None:
+        """
+        qps : 账户的每秒请求数限制（标准版 1，高级版 10，尊享版 100）
+        max_concurrency : 同时在途的请求数上限
+        """
         self.url  = '/api/trans/vip/translate'
         self.appid = appid
         self.secretKey = secretKey
+        # 单次请求的最大字符数（接口限制 q 不超过 6000 字节），超出部分由调用方拆成多个请求
+        self.batch_max_chars = 1500
+        self.qps = qps
+        self.max_concurrency = max_concurrency
+        self.timeout = 30
+        self.host = 'api.fanyi.baidu.com'
+        self.port = None
+        # 空闲的 keep-alive 连接池，所有线程、所有文件共用：请求时取一个，用完放回，省去重复建连
+        # 连接数不会超过同时在途的请求数
+        self.pool = queue.LifoQueue()
 
-    def reset(self):
+    def reset(self,target_language=None):
         pass
    
-    def run(self,text,from_language='auto',target_language='中文'):
+    def language_code(self,target_language):
+        # 不在表中的按语言代码原样传给接口
+        return self.LANGUAGE_CODES.get(target_language, target_language)
 
-        if target_language == "中文":
-            target_language = 'zh'
-        elif target_language == "日语":
-            target_language = 'jp'
-        elif target_language == "英语":
-            target_language = 'en'
-        
+    def connection(self):
+        """
+        从连接池取一个空闲连接，没有时新建
+        """
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def post(self,body):
+        """
+        用连接池中的长连接发送请求，用完放回；复用的连接已被服务端关闭时新建连接再发一次
+        """
+        for attempt in range(2):
+            conn = self.connection() if attempt == 0 else HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request('POST', self.url, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+                response = conn.getresponse()
+                # 必须读完响应，连接才能复用
+                data = response.read().decode("utf-8")
+            except (HTTPException, OSError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                conn.close()
+            else:
+                self.pool.put(conn)
+            return data
+
+    def close(self):
+        """
+        关闭连接池中的所有连接
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def request(self,text,from_language,target_language):
+        """
+        发送一次请求，返回 trans_result 列表，每个元素对应 text 中的一行
+        """
         salt = randint(32768, 65536)
         sign = self.appid + text + str(salt) + self.secretKey
         sign = md5(sign.encode()).hexdigest()
-        get_url = self.url + '?appid=' + self.appid + '&q=' + parse.quote(text) + '&from=' + from_language + '&to=' + target_language + '&salt=' + str(
-            salt) + '&sign=' + sign
+        # 多行合并后 query 较长，用 POST 表单提交，避免 URL 超长
+        body = parse.urlencode({'appid': self.appid, 'q': text, 'from': from_language, 'to': target_language,
+                                'salt': str(salt), 'sign': sign})
         
+        result_all = self.post(body)
+        result = json.loads(result_all)
         try:
-            httpClient = HTTPConnection('api.fanyi.baidu.com')
-            httpClient.request('GET', get_url)
-
-            response = httpClient.getresponse()
-            result_all = response.read().decode("utf-8")
-            result = json.loads(result_all)
-
-            string = ''
-            for word in result['trans_result']:
-                if word == result['trans_result'][-1]:
-                    string += word['dst']
-                else:
-                    string += word['dst'] + '\n'
+            return result['trans_result']
 
-        except Exception:
+        except KeyError:
             if result['error_code'] == '54003':
                 string = "翻译：我抽风啦！"
             elif result['error_code'] == '52001':
@@ -64,13 +126,29 @@ class Baidu:
                 string = '翻译：认证未通过或未生效'
             else:
                 string = '翻译：%s，%s' % (result['error_code'], result['error_msg'])
-            raise Exception(string)
-        
-        finally:
-            if httpClient:
-                httpClient.close()
+            raise BaiduError(string, result['error_code'])
+
+    def run(self,text,from_language='auto',target_language='中文'):
+        target_language = self.language_code(target_language)
+        trans_result = self.request(text,from_language,target_language)
+        return '\n'.join(word['dst'] for word in trans_result)
 
-        return string
+    def run_batch(self,texts,from_language='auto',target_language='中文'):
+        """
+        多行合并成一个以换行分隔的 q 发送，按返回的 src 对应回每一行
+        对不上的行返回 None，由调用方逐行重译
+        """
+        target_language = self.language_code(target_language)
+        trans_result = self.request('\n'.join(texts),from_language,target_language)
+        results = []
+        pos = 0
+        for text in texts:
+            if pos < len(trans_result) and trans_result[pos]['src'].strip() == text.strip():
+                results.append(trans_result[pos]['dst'])
+                pos += 1
+            else:
+                results.append(None)
+        return results
 
 
 if __name__ == '__main__':
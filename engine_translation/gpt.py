@@ -1,7 +1,81 @@
+import re
+import json
+import threading
+from collections import deque
 from openai import OpenAI
+try:
+    # 可选依赖，安装后按模型的分词器精确计算 token 数
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class ContextWindow:
+    """
+    GPT 的对话上下文：只保留最近若干轮问答，总 token 数不超过 max_tokens
+    超出窗口的旧对话被移出，可由调用方压缩成一段摘要放在系统提示之后
+    """
+    def __init__(self,model="gpt-3.5-turbo",max_tokens=2000,max_turns=20) -> None:
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.reset()
+
+    def reset(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = ""
+        # 移出窗口、还没有并入摘要的旧对话
+        self.evicted = []
+
+    def count_tokens(self,text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        # 没有 tiktoken 时粗略估算：中日韩字符约 1 个 token，其余约 4 个字符 1 个 token
+        cjk = len(re.findall(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+        return cjk + (len(text) - cjk + 3) // 4 + 4
+
+    def build(self,system_message,new_message):
+        """
+        返回本次请求要发送的消息：系统提示、摘要、窗口内的历史、新消息
+        """
+        messages = [system_message]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier subtitles: {self.summary}"})
+        for user_message, assistant_message, _ in self.turns:
+            messages += [user_message, assistant_message]
+        messages.append(new_message)
+        return messages
+
+    def add(self,user_message,assistant_message):
+        """
+        加入一轮问答，返回被移出窗口的旧问答列表
+        """
+        tokens = self.count_tokens(user_message["content"]) + self.count_tokens(assistant_message["content"])
+        self.turns.append((user_message, assistant_message, tokens))
+        self.tokens += tokens
+        evicted = []
+        # 至少保留最新的一轮
+        while len(self.turns) > 1 and (self.tokens > self.max_tokens or len(self.turns) > self.max_turns):
+            turn = self.turns.popleft()
+            self.tokens -= turn[2]
+            evicted.append(turn)
+        return evicted
+
 
 class GPT():
-    def __init__(self,key,base_url = "https://api.openai.com/v1",model="gpt-3.5-turbo",temperature=0.6) -> None:
+    def __init__(self,key,base_url = "https://api.openai.com/v1",model="gpt-3.5-turbo",temperature=0.6,qps=3,max_concurrency=4,
+                 context_tokens=2000,context_turns=20,summarize=False) -> None:
+        """
+        context_tokens : 每次请求附带的历史对话 token 上限
+        context_turns : 每次请求附带的历史对话轮数上限
+        summarize : 是否把移出窗口的旧对话压缩成摘要继续带上
+        """
         self.client = OpenAI(
             api_key = key,
             base_url = base_url
@@ -12,19 +86,47 @@ class GPT():
         
         self.model = model
         self.temperature = temperature
+        # 批量翻译时单次请求的最大字符数
+        self.batch_max_chars = 1500
+        # 并发请求数和每秒请求数限制
+        self.qps = qps
+        self.max_concurrency = max_concurrency
+        # 带上下文翻译：同一目标语言的请求必须逐个按顺序发送，否则历史记录顺序错乱；
+        # max_concurrency 只用于同时翻译多个目标语言（各语言上下文独立）
+        self.sequential = True
+        # 并发翻译时保护 self.contexts
+        self.lock = threading.Lock()
+        self.context_tokens = context_tokens
+        self.context_turns = context_turns
+        self.summarize = summarize
+        # 每移出这么多轮旧对话更新一次摘要
+        self.summary_every = 10
         self.prompt = "You are a language expert.Your task is to translate the input subtitle text, sentence by sentence, into the user specified target language.However, please utilize the context to improve the accuracy and quality of translation.Please be aware that the input text could contain typos and grammar mistakes, utilize the context to correct the translation.Please return only translated content and do not include the origin text.Please do not use any punctuation around the returned text.Please do not translate people's name and leave it as original language.\""
         self.reset()
 
-    def reset(self):
+    def reset(self,target_language=None):
         """
         清空历史记录
+        target_language : 只清空这个目标语言的上下文，其它语言可能正在翻译；None 为全部清空
         """
-        self.messages = [
-            {
-                "role": "system",
-                "content": f'{self.prompt}'
-            }
-        ]
+        if target_language is not None:
+            with self.lock:
+                self.contexts.pop(target_language, None)
+            return
+        self.system_message = {
+            "role": "system",
+            "content": f'{self.prompt}'
+        }
+        # 每个目标语言一个上下文，同时翻译成多种语言时历史互不混杂
+        self.contexts = {}
+
+    def context(self,target_language):
+        """
+        返回 target_language 对应的上下文窗口，调用方需持有 self.lock
+        """
+        if target_language not in self.contexts:
+            self.contexts[target_language] = ContextWindow(self.model, self.context_tokens, self.context_turns)
+        return self.contexts[target_language]
 
     def run(self,text,target_language="zh-hans"):
         """
@@ -44,27 +146,90 @@ class GPT():
                 "role":"user",
                 "content": f"Original text:`{text}`. Target language: {target_language}"
         }
-        self.messages.append(new_message)
+        return self.chat(new_message, target_language)
+
+    def chat(self,new_message,target_language):
+        """
+        带上 target_language 的历史记录发送 new_message，成功后把问答一起写入历史
+        并发调用时各自使用发送时刻的历史快照，请求失败不会留下半条记录
+        """
+        with self.lock:
+            context = self.context(target_language)
+            messages = context.build(self.system_message, new_message)
+        # 出错时直接抛出 openai 的原始异常（RateLimitError、AuthenticationError 等），便于调用方区分处理
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            messages= messages,
+            temperature=self.temperature,
+            stream = False
+        )
+        
+        content = (
+            completion.choices[0].message.content.encode("utf8").decode()
+        )
+        # total_tokens = completion.usage.total_tokens     
+        # 将其保存成历史，超出窗口的旧对话被移出
+        with self.lock:
+            evicted = context.add(new_message, {"role": "assistant", "content": content})
+        if evicted and self.summarize:
+            self.update_summary(context, evicted)
+        return content
+
+    def update_summary(self,context,evicted):
+        """
+        累积移出窗口的旧对话，每 summary_every 轮请求一次，把它们和旧摘要合并成新摘要
+        摘要失败不影响翻译，保留旧摘要
+        """
+        with self.lock:
+            context.evicted += evicted
+            if len(context.evicted) < self.summary_every:
+                return
+            evicted, context.evicted = context.evicted, []
+            summary = context.summary
+        history = "\n".join(f"{user['content']}\n=> {assistant['content']}" for user, assistant, _ in evicted)
         try:
             completion = self.client.chat.completions.create(
                 model=self.model,
-                messages= self.messages,
-                temperature=self.temperature,
+                messages=[{
+                    "role": "user",
+                    "content": "Summarize the subtitle translation history below in under 120 words, "
+                               "keeping people's names, recurring terms and how they were translated, and the current topic.\n"
+                               f"Previous summary: {summary or 'none'}\nHistory:\n{history}"
+                }],
+                temperature=0,
                 stream = False
             )
-            
-            content = (
-                completion.choices[0].message.content.encode("utf8").decode()
-            )
-            # total_tokens = completion.usage.total_tokens     
-
+            with self.lock:
+                context.summary = completion.choices[0].message.content.strip()
         except Exception as e:
-            self.messages.pop()
-            raise Exception(e)
-        # 将其保存成历史
-        self.messages.append({"role": "assistant", "content": content})
-        # print("{}".format(self.messages))
-        return content
+            print("更新上下文摘要出错：{}".format(e))
+
+    def run_batch(self,texts,target_language="zh-hans"):
+        """
+        将多行字幕编号后以 JSON 一次发送，要求按相同编号返回译文
+        缺失或无法解析的行返回 None，由调用方逐行重译
+        """
+        source = {str(i + 1): text for i, text in enumerate(texts)}
+        new_message = {
+                "role":"user",
+                "content": f"Translate every value of the following JSON object into {target_language}. "
+                           f"Reply with only a JSON object that has exactly the same keys, "
+                           f"each value being the translation of that line:\n{json.dumps(source, ensure_ascii=False)}"
+        }
+        content = self.chat(new_message, target_language)
+
+        try:
+            # 去掉可能出现的 ```json 代码块标记
+            reply = json.loads(content[content.index("{"):content.rindex("}") + 1])
+        except ValueError:
+            reply = {}
+        if not isinstance(reply, dict):
+            reply = {}
+        results = []
+        for key in source:
+            value = reply.get(key)
+            results.append(value.strip() if isinstance(value, str) and value.strip() else None)
+        return results
 
 
 if __name__ == '__main__':
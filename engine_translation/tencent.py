@@ -1,4 +1,5 @@
 import json
+import queue
 # pip install -i https://mirrors.tencent.com/pypi/simple/ --upgrade tencentcloud-sdk-python
 from tencentcloud.common import credential
 from tencentcloud.common.profile.client_profile import ClientProfile
@@ -7,29 +8,67 @@ from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentClo
 from tencentcloud.tmt.v20180321 import tmt_client, models
 
 class Tencent:
-    def __init__(self,appid,secretKey) -> None:
+    # 界面上的语言名到腾讯翻译语言代码（注意日语是 ja，与百度的 jp 不同）
+    LANGUAGE_CODES = {
+        "中文": "zh", "繁体中文": "zh-TW", "日语": "ja", "英语": "en", "韩语": "ko",
+        "法语": "fr", "西班牙语": "es", "德语": "de", "俄语": "ru",
+    }
+
+    def __init__(self,appid,secretKey,qps=5,max_concurrency=4) -> None:
+        """
+        qps : 账户的每秒请求数限制（文本翻译默认 5）
+        max_concurrency : 同时在途的请求数上限
+        """
         self.appid = appid
         self.secretKey = secretKey
+        # 批量接口单次请求的最大字符数（接口限制总长度不超过 6000 字符）
+        self.batch_max_chars = 2000
+        self.qps = qps
+        self.max_concurrency = max_concurrency
+        self.endpoint = "tmt.tencentcloudapi.com"
+        self.scheme = "https"
+        # 空闲的 TmtClient 池（各自保持 keep-alive 连接），所有线程、所有文件共用：请求时取一个，用完放回
+        self.pool = queue.LifoQueue()
 
-    def reset(self):
+    def reset(self,target_language=None):
         pass
     
-    def run(self,text,from_language='auto',target_language='中文'):
+    def language_code(self,target_language):
+        # 不在表中的按语言代码原样传给接口
+        return self.LANGUAGE_CODES.get(target_language, target_language)
+
+    def client(self):
+        """
+        从池中取一个空闲的 TmtClient，没有时新建；用完由调用方放回 self.pool
+        """
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        cred = credential.Credential(self.appid, self.secretKey)
+        httpProfile = HttpProfile()
+        httpProfile.endpoint = self.endpoint
+        httpProfile.scheme = self.scheme
+        httpProfile.keepAlive = True
+        clientProfile = ClientProfile()
+        clientProfile.httpProfile = httpProfile
+        return tmt_client.TmtClient(cred, "ap-chengdu", clientProfile)
 
-        if target_language == "中文":
-            target_language = 'zh'
-        elif target_language == "日语":
-            target_language = 'jp'
-        elif target_language == "英语":
-            target_language = 'en'
+    def close(self):
+        """
+        丢弃池中的所有 TmtClient
+        """
+        while True:
+            try:
+                self.pool.get_nowait()
+            except queue.Empty:
+                break
+
+    def run(self,text,from_language='auto',target_language='中文'):
+        target_language = self.language_code(target_language)
         
+        client = self.client()
         try:
-            cred = credential.Credential(self.appid, self.secretKey)
-            httpProfile = HttpProfile()
-            httpProfile.endpoint = "tmt.tencentcloudapi.com"
-            clientProfile = ClientProfile()
-            clientProfile.httpProfile = httpProfile
-            client = tmt_client.TmtClient(cred, "ap-chengdu", clientProfile)
             req = models.TextTranslateRequest()
             params = {
                 "SourceText": text,
@@ -45,6 +84,31 @@ class Tencent:
         
         except TencentCloudSDKException as err:
             raise err
+        finally:
+            self.pool.put(client)
+
+    def run_batch(self,texts,from_language='auto',target_language='中文'):
+        """
+        使用 TextTranslateBatch 一次翻译多行
+        返回条数与输入不一致时全部返回 None，由调用方逐行重译
+        """
+        target_language = self.language_code(target_language)
+        client = self.client()
+        try:
+            req = models.TextTranslateBatchRequest()
+            params = {
+                "SourceTextList": list(texts),
+                "Source": from_language,
+                "Target": target_language,
+                'ProjectId': 0
+            }
+            req.from_json_string(json.dumps(params))
+            resp = client.TextTranslateBatch(req).TargetTextList or []
+        finally:
+            self.pool.put(client)
+        if len(resp) != len(texts):
+            return [None] * len(texts)
+        return list(resp)
 
 
 if __name__ == '__main__':
@@ -54,6 +118,6 @@ if __name__ == '__main__':
     secretId = config["tencent"]["secretId"]
     secretKey = config["tencent"]["secretKey"]
     t = Tencent(appid=secretId,secretKey=secretKey)
-    print(t.run( "まるでおとぎの話 終わり迎えた証",from_language='jp',target_language='中文'))
+    print(t.run( "まるでおとぎの話 終わり迎えた証",from_language='ja',target_language='中文'))
     
     
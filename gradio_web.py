@@ -8,11 +8,13 @@ import base64
 import io
 import ffmpeg
 from translation import GPT, Baidu, Tencent, translation
-from utils import extract_audio, merge_subtitles_to_video, clear_folder, import_config_file
+from utils import extract_audio, merge_subtitles_to_video, clear_folder, import_config_file, AudioStore
 from uvr import UVR_Client
 
 # 临时文件存放地址
 TEMP = "./temp"
+# 解码后音频的共享存储，同一个媒体只解码一次
+audio_store = AudioStore()
 
 # 全局变量存储状态
 class AppState:
@@ -176,8 +178,8 @@ def clean_audio():
             print("[INFO] UVR模型加载完成")
         
         print(f"[INFO] 开始处理音频文件: {app_state.audio_temp}")
-        primary_stem_output_path, secondary_stem_output_path = app_state.uvr_client.infer(app_state.audio_temp)
-        app_state.audio_separator_temp = os.path.join('./temp', secondary_stem_output_path)
+        # 分段分离：内存占用只和窗口长度有关，长音频也不会占满内存；只分离检测到背景音乐的区域
+        app_state.audio_separator_temp = app_state.uvr_client.infer_chunked(app_state.audio_temp, audio_store=audio_store, gate=True)
         
         print(f"[INFO] 音频清洁完成，输出文件: {app_state.audio_separator_temp}")
         return "音频清洁完成", app_state.audio_separator_temp
@@ -264,10 +266,9 @@ def process_subtitle(language, vad_filter, min_silence_duration, text_split, spl
         
         print(f"开始处理音频：{input_audio}")
         
-        # 生成字幕
-        srt, ass = app_state.transcribe.run(
+        transcribe_params = dict(
             file_name=input_audio,
-            audio_binary_io=input_audio,
+            audio_binary_io=audio_store.get(input_audio),
             language=lang_code,
             is_vad_filter=is_vad_filter,
             min_silence_duration_ms=min_silence_ms,
@@ -275,6 +276,19 @@ def process_subtitle(language, vad_filter, min_silence_duration, text_split, spl
             split_method=split_method,
             initial_prompt=initial_prompt
         )
+        translate_ass = translate_srt = None
+        if app_state.engine is None:
+            # 生成字幕（从解码音频存储中映射读取，不再由faster-whisper重复解码）
+            srt, ass = app_state.transcribe.run(**transcribe_params)
+        else:
+            # 边转录边翻译：转录出的分段随即送去翻译，不必等整个文件转录完
+            print("开始转录并翻译...")
+            audio_name = os.path.splitext(os.path.basename(input_audio))[0]
+            srt = os.path.join(TEMP, audio_name + ".srt")
+            ass = os.path.join(TEMP, audio_name + ".ass")
+            t = translation(app_state.engine)
+            translate_ass, translate_srt = t.transcribe_translate_save(
+                app_state.transcribe.stream(**transcribe_params), ass)
         
         # 创建下载包
         zip_name = os.path.splitext(os.path.basename(app_state.audio_temp))[0] + ".zip"
@@ -285,10 +299,7 @@ def process_subtitle(language, vad_filter, min_silence_duration, text_split, spl
             zipObj.write(ass, os.path.basename(ass))
             
             # 如果需要翻译
-            if app_state.engine is not None:
-                print("开始翻译...")
-                t = translation(app_state.engine)
-                translate_ass, translate_srt = t.translate_save(ass)
+            if translate_ass is not None:
                 zipObj.write(translate_ass, os.path.basename(translate_ass))
                 zipObj.write(translate_srt, os.path.basename(translate_srt))
         
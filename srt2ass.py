@@ -8,24 +8,79 @@ import sys
 import os
 import regex as re
 import codecs
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# BOMs are checked longest first, the utf-32 LE BOM starts with the utf-16 LE one.
+# A utf-8 BOM keeps plain "utf-8" so the BOM survives decoding and is copied to the output.
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+    (codecs.BOM_UTF8, "utf-8"),
+]
+# without a BOM, legacy CJK codecs are tried before cp1252, which accepts almost any byte
+SNIFF_ORDER = ["utf-8", "gb2312", "gbk", "big5", "cp1252"]
+SNIFF_SIZE = 64 * 1024
 
 
 def fileopen(input_file):
     # use correct codec to encode the input file
-    encodings = ["utf-32", "utf-16", "utf-8", "cp1252", "gb2312", "gbk", "big5"]
     srt_src = ''
-    for enc in encodings:
+    enc = None
+    for enc in sniff_encodings(input_file):
         try:
-            with codecs.open(input_file, mode="r", encoding=enc) as fd:
-                # return an instance of StreamReaderWriter
-                srt_src = fd.read()
-                break
-        except:
+            srt_src = ''.join(_read_blocks(input_file, enc))
+            break
+        except UnicodeError:
             # print enc + ' failed'
+            srt_src = ''
             continue
     return [srt_src, enc]
 
 
+def sniff_encodings(input_file, sample_size=SNIFF_SIZE):
+    # guess the codec from a BOM or from a bounded sample of leading bytes,
+    # the codecs that decode the sample come first, the others are kept as fallbacks
+    with open(input_file, 'rb') as fd:
+        sample = fd.read(sample_size)
+    for bom, enc in BOMS:
+        if sample.startswith(bom):
+            return [enc] + [e for e in SNIFF_ORDER if e != enc]
+
+    matched = []
+    for enc in SNIFF_ORDER:
+        decoder = codecs.getincrementaldecoder(enc)()
+        try:
+            # final=False: a multi-byte sequence cut at the end of the sample is fine
+            decoder.decode(sample, final=False)
+            matched.append(enc)
+        except UnicodeError:
+            continue
+    return matched + [enc for enc in SNIFF_ORDER if enc not in matched]
+
+
+def _read_blocks(input_file, encoding, block_size=1 << 20):
+    # decode like codecs.open().read(): an incomplete trailing sequence is dropped
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(input_file, 'rb') as fd:
+        for block in iter(lambda: fd.read(block_size), b''):
+            text = decoder.decode(block)
+            if text:
+                yield text
+
+
+def _read_lines(input_file, encoding):
+    # split on "\n" only, the same way srt_content.split("\n") did
+    rest = ''
+    for text in _read_blocks(input_file, encoding):
+        lines = (rest + text).split('\n')
+        rest = lines.pop()
+        yield from lines
+    yield rest
+
+
 def srt2ass(input_file,sub_style, is_split:bool, split_method:str):
     if '.ass' in input_file:
         return input_file
@@ -34,111 +89,177 @@ def srt2ass(input_file,sub_style, is_split:bool, split_method:str):
         print(input_file + ' not exist')
         return
 
-    src = fileopen(input_file)
-    srt_content = src[0]
-    # encoding = src[1] # Will not encode so do not need to pass codec para
-    src = ''
-    utf8bom = ''
-
-    if u'\ufeff' in srt_content:
-        srt_content = srt_content.replace(u'\ufeff', '')
-        utf8bom = u'\ufeff'
-    
-    srt_content = srt_content.replace("\r", "")
-    lines = [x.strip() for x in srt_content.split("\n") if x.strip()]
-    subLines = ''
-    dlgLines = '' # dialogue line
-    lineCount = 0
     output_file = '.'.join(input_file.split('.')[:-1])
     output_file += '.ass'
 
-    for ln in range(len(lines)):
-        line = lines[ln]
-        if line.isdigit() and re.match('-?\d\d:\d\d:\d\d', lines[(ln+1)]):
-            if dlgLines:
-                subLines += dlgLines + "\n"
-            dlgLines = ''
-            lineCount = 0
+    # the source is decoded once and parsed line by line, every dialogue block is
+    # written out as soon as it is complete, so memory stays flat and the work is linear.
+    # If the sniffed codec fails past the sample, the output is rebuilt with the next one.
+    for encoding in sniff_encodings(input_file) + [None]:
+        lines = _read_lines(input_file, encoding) if encoding else iter(())
+        try:
+            first_line = next(lines, '')
+            utf8bom = u'\ufeff' if u'\ufeff' in first_line else ''
+            bom_seen = bool(utf8bom)
+            with AssWriter(output_file, sub_style, is_split, split_method, utf8bom) as writer:
+                for line in itertools.chain([first_line], lines):
+                    if u'\ufeff' in line:
+                        line = line.replace(u'\ufeff', '')
+                        bom_seen = True
+                    writer.write_line(line.replace("\r", ""))
+            break
+        except UnicodeError:
+            print(input_file + ' is not ' + encoding + ', retrying')
             continue
-        else:
-            if re.match('-?\d\d:\d\d:\d\d', line):
-                line = line.replace('-0', '0')
-                if sub_style =='default':
-                    dlgLines += 'Dialogue: 0,' + line + ',default,,0,0,0,,'
-                elif sub_style =='ikedaCN':
-                    dlgLines += 'Dialogue: 0,' + line + ',池田字幕1080p,,0,0,0,,'
-                elif sub_style == 'sugawaraCN':
-                    dlgLines += 'Dialogue: 0,' + line + ',中字 1080P,,0,0,0,,'
-                elif sub_style == 'kaedeCN':
-                    dlgLines += 'Dialogue: 0,' + line + ',den SR红色,,0,0,0,,'
-                elif sub_style == 'taniguchiCN':
-                    dlgLines += 'Dialogue: 0,' + line + ',正文_1080P,,0,0,0,,'
-                elif sub_style == 'asukaCN':
-                    dlgLines += 'Dialogue: 0,' + line + ',DEFAULT1,,0,0,0,,'
-            else:
-                if lineCount < 2:
-                    dlg_string = line
-                    if is_split == True and split_method == 'Modest':
-                        # do not split if space proceed and followed by non-ASC-II characters
-                        # do not split if space followed by word that less than 5 characters
-                        split_string = re.sub(r'(?<=[^\x00-\x7F])\s+(?=[^\x00-\x7F])(?=\w{5})', r'|', dlg_string)
-                        # print(split_string)
-                        if len(split_string.split('|')) > 1:
-                            dlgLines += (split_string.replace('|', "(adjust_required)\n" + dlgLines)) + "(adjust_required)"
-                        else:
-                            dlgLines += line
-                    elif is_split == True and split_method == 'Aggressive':
-                        # do not split if space proceed and followed by non-ASC-II characters
-                        # split at all the rest spaces
-                        split_string = re.sub(r'(?<=[^\x00-\x7F])\s+(?=[^\x00-\x7F])', r'|', dlg_string)
-                        if len(split_string.split('|')) > 1:
-                            dlgLines += (split_string.replace('|',"(adjust_required)\n" + dlgLines)) + "(adjust_required)"
-                        else:
-                            dlgLines += line
-                    else:
-                        dlgLines += line
-                else:
-                    dlgLines += "\n" + line
-            lineCount += 1
-        ln += 1
-
-
-    subLines += dlgLines + "\n"
-
-    subLines = re.sub(r'\d(\d:\d{2}:\d{2}),(\d{2})\d', '\\1.\\2', subLines)
-    subLines = re.sub(r'\s+-->\s+', ',', subLines)
-    # replace style
-    # subLines = re.sub(r'<([ubi])>', "{\\\\\g<1>1}", subLines)
-    # subLines = re.sub(r'</([ubi])>', "{\\\\\g<1>0}", subLines)
-    # subLines = re.sub(r'<font\s+color="?#(\w{2})(\w{2})(\w{2})"?>', "{\\\\c&H\\3\\2\\1&}", subLines)
-    # subLines = re.sub(r'</font>', "", subLines)
-
-    if sub_style == 'default':
-        head_name = 'head_str_default'
-    elif sub_style == 'ikedaCN':
-        head_name = 'head_str_ikeda'
-    elif sub_style == 'sugawaraCN':
-        head_name = 'head_str_sugawara'
-    elif sub_style == 'kaedeCN':
-        head_name = 'head_str_kaede'
-    elif sub_style == "taniguchiCN":
-        head_name = 'head_str_taniguchi'
-    elif sub_style == 'asukaCN':
-        head_name = 'head_str_asuka'
-
-    head_str = STYLE_DICT.get(head_name)
-    output_str = utf8bom + head_str + '\n' + subLines
-    # encode again for head string
-    output_str = output_str.encode('utf8')
-
-    with open(output_file, 'wb') as output:
-        output.write(output_str)
 
+    if bom_seen and not utf8bom:
+        # a BOM somewhere after the first line still marks the output as BOM-prefixed
+        with open(output_file, 'rb') as output:
+            output_str = output.read()
+        with open(output_file, 'wb') as output:
+            output.write(u'\ufeff'.encode('utf8') + output_str)
+
+    return escape_path(output_file)
+
+
+TIMESTAMP_RE = re.compile(r'-?\d\d:\d\d:\d\d')
+MODEST_SPLIT_RE = re.compile(r'(?<=[^\x00-\x7F])\s+(?=[^\x00-\x7F])(?=\w{5})')
+AGGRESSIVE_SPLIT_RE = re.compile(r'(?<=[^\x00-\x7F])\s+(?=[^\x00-\x7F])')
+ASS_TIME_RE = re.compile(r'\d(\d:\d{2}:\d{2}),(\d{2})\d')
+ARROW_RE = re.compile(r'\s+-->\s+')
+
+# sub_style -> (head string key in STYLE_DICT, style name used by dialogue lines)
+SUB_STYLES = {
+    'default': ('head_str_default', 'default'),
+    'ikedaCN': ('head_str_ikeda', '池田字幕1080p'),
+    'sugawaraCN': ('head_str_sugawara', '中字 1080P'),
+    'kaedeCN': ('head_str_kaede', 'den SR红色'),
+    'taniguchiCN': ('head_str_taniguchi', '正文_1080P'),
+    'asukaCN': ('head_str_asuka', 'DEFAULT1'),
+}
+
+
+def escape_path(output_file):
+    # escape the path so that it can be passed to the ffmpeg subtitles filter
     output_file = output_file.replace('\\', '\\\\')
     output_file = output_file.replace('/', '//')
     return output_file
 
 
+class AssWriter:
+    """
+    Incremental SRT -> ASS converter.
+    SRT lines are fed one by one with write_line() and every finished dialogue
+    block is written out right away, so the .ass file can be read while it is
+    still being produced. The conversion rules are the same as srt2ass().
+    """
+
+    def __init__(self, output_file, sub_style, is_split, split_method, utf8bom=''):
+        head_name, self.style_name = SUB_STYLES[sub_style]
+        self.is_split = is_split
+        self.split_method = split_method
+        self.output_file = output_file
+        self.dlgLines = ''
+        self.lineCount = 0
+        # a digit line is an index only if a timestamp follows, so it waits for the next line
+        self.pending = None
+        self.output = open(output_file, 'wb')
+        self.output.write((utf8bom + STYLE_DICT.get(head_name) + '\n').encode('utf8'))
+
+    def _write_block(self, block):
+        block = ASS_TIME_RE.sub('\\1.\\2', block + "\n")
+        block = ARROW_RE.sub(',', block)
+        self.output.write(block.encode('utf8'))
+
+    def _process(self, line, next_line):
+        if line.isdigit() and next_line is not None and TIMESTAMP_RE.match(next_line):
+            if self.dlgLines:
+                self._write_block(self.dlgLines)
+            self.dlgLines = ''
+            self.lineCount = 0
+            return
+
+        dlgLines = self.dlgLines
+        if TIMESTAMP_RE.match(line):
+            line = line.replace('-0', '0')
+            dlgLines += 'Dialogue: 0,' + line + ',' + self.style_name + ',,0,0,0,,'
+        elif self.lineCount < 2:
+            split_string = None
+            if self.is_split == True and self.split_method == 'Modest':
+                # do not split if space proceed and followed by non-ASC-II characters
+                # do not split if space followed by word that less than 5 characters
+                split_string = MODEST_SPLIT_RE.sub(r'|', line)
+            elif self.is_split == True and self.split_method == 'Aggressive':
+                # do not split if space proceed and followed by non-ASC-II characters
+                # split at all the rest spaces
+                split_string = AGGRESSIVE_SPLIT_RE.sub(r'|', line)
+            if split_string is not None and len(split_string.split('|')) > 1:
+                dlgLines += (split_string.replace('|', "(adjust_required)\n" + dlgLines)) + "(adjust_required)"
+            else:
+                dlgLines += line
+        else:
+            dlgLines += "\n" + line
+        self.dlgLines = dlgLines
+        self.lineCount += 1
+
+    def write_line(self, line):
+        """
+        Feed one line of the SRT source. Blank lines are ignored.
+        """
+        line = line.strip()
+        if not line:
+            return
+        if self.pending is not None:
+            self._process(self.pending, line)
+            self.pending = None
+        if line.isdigit():
+            self.pending = line
+        else:
+            self._process(line, None)
+
+    def dialogue_count(self):
+        """
+        Number of Dialogue lines in the block that is still being built,
+        i.e. the subtitle entry fed most recently (more than one when is_split
+        breaks it up).
+        """
+        return sum(line.startswith('Dialogue:') for line in self.dlgLines.split('\n'))
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        if self.output.closed:
+            return
+        if self.pending is not None:
+            self._process(self.pending, None)
+            self.pending = None
+        self._write_block(self.dlgLines)
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def srt2ass_dir(input_dir, sub_style, is_split:bool, split_method:str, max_workers=None, recursive=False):
+    # convert every .srt under input_dir, one file per worker process
+    input_files = []
+    for root, dirs, files in os.walk(input_dir):
+        input_files += [os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.srt')]
+        if not recursive:
+            break
+    if not input_files:
+        print(input_dir + ' has no srt file')
+        return []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(srt2ass, name, sub_style, is_split, split_method) for name in input_files]
+        return [future.result() for future in futures]
+
+
 # if len(sys.argv) > 1:
 #     for name in sys.argv[1:]:
 #         srt2ass(name,sub_style=)
@@ -294,4 +415,16 @@ Dialogue: 0,0:00:00.00,0:00:05.00,Default,,0,0,0,,'''
 
 
 # if __name__ == "__main__":
-#     srt2ass('sub_split_test.srt','sugawaraCN','No','Aggressive')
\ No newline at end of file
+#     srt2ass('sub_split_test.srt','sugawaraCN','No','Aggressive')
+
+
+if __name__ == "__main__":
+    # python srt2ass.py <srt file or directory> [sub_style] [Modest|Aggressive]
+    if len(sys.argv) > 1:
+        style = sys.argv[2] if len(sys.argv) > 2 else 'default'
+        method = sys.argv[3] if len(sys.argv) > 3 else ''
+        if os.path.isdir(sys.argv[1]):
+            for name in srt2ass_dir(sys.argv[1], style, bool(method), method, recursive=True):
+                print(name)
+        else:
+            print(srt2ass(sys.argv[1], style, bool(method), method))
\ No newline at end of file
@@ -0,0 +1,141 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+import pytest
+
+import translation as tr
+from engine_translation.baidu import Baidu
+from engine_translation.tencent import Tencent
+
+
+class StandInServer:
+    """
+    本地的翻译接口替身：支持 keep-alive，记录每个请求来自哪个客户端连接
+    """
+    def __init__(self, respond):
+        connections = self.connections = []
+        server = self
+        # 为 False 时回完即断开（不带 Connection: close），模拟服务端关闭空闲连接
+        self.keep_alive = True
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                # 在回复之前决定是否断开，客户端收到回复后测试可能已经改了 keep_alive
+                close = not server.keep_alive
+                connections.append(self.client_address)
+                data = json.dumps(respond(self.headers, body), ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                self.close_connection = close
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def baidu_respond(headers, body):
+    q = parse.parse_qs(body.decode("utf-8"))["q"][0]
+    return {"trans_result": [{"src": line, "dst": "译:" + line} for line in q.split("\n")]}
+
+
+def tencent_respond(headers, body):
+    params = json.loads(body)
+    if headers["X-TC-Action"] == "TextTranslateBatch":
+        return {"Response": {"TargetTextList": ["译:" + t for t in params["SourceTextList"]], "RequestId": "1"}}
+    return {"Response": {"TargetText": "译:" + params["SourceText"], "RequestId": "1"}}
+
+
+@pytest.fixture
+def baidu_server():
+    server = StandInServer(baidu_respond)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def tencent_server():
+    server = StandInServer(tencent_respond)
+    yield server
+    server.close()
+
+
+def baidu_engine(server):
+    engine = Baidu(appid="appid", secretKey="key")
+    engine.host, engine.port = "127.0.0.1", server.port
+    return engine
+
+
+def test_baidu_reuses_one_connection_across_threads(baidu_server):
+    engine = baidu_engine(baidu_server)
+    # 每次用新的线程池（新线程）发送，模拟逐个文件、逐批翻译
+    for i in range(5):
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(engine.run, "line {}".format(i)).result() == "译:line {}".format(i)
+    assert len(baidu_server.connections) == 5
+    assert len(set(baidu_server.connections)) == 1
+    engine.close()
+    assert engine.pool.empty()
+
+
+def test_baidu_connections_shared_across_translate_calls(baidu_server):
+    engine = baidu_engine(baidu_server)
+    engine.qps = None
+    t = tr.translation(engine, memory_path=None)
+    texts = ["line {}".format(i) for i in range(20)]
+    for _ in range(3):
+        assert t.translate_lines(texts, batch_size=2, use_memory=False) == ["译:" + text for text in texts]
+    assert len(baidu_server.connections) == 30
+    # 连接数不超过引擎的并发上限，而且多次调用之间复用
+    assert len(set(baidu_server.connections)) <= engine.max_concurrency
+
+
+def test_baidu_reconnects_after_server_closes_idle_connection(baidu_server):
+    engine = baidu_engine(baidu_server)
+    baidu_server.keep_alive = False
+    assert engine.run("a") == "译:a"
+    baidu_server.keep_alive = True
+    # 池中的连接已被服务端关闭，请求失败后新建连接重发
+    assert engine.run("b") == "译:b"
+    assert engine.run("c") == "译:c"
+    assert len(baidu_server.connections) == 3
+    assert len(set(baidu_server.connections)) == 2
+
+
+def test_tencent_reuses_one_connection(tencent_server):
+    engine = Tencent(appid="id", secretKey="key")
+    engine.endpoint, engine.scheme = "127.0.0.1:{}".format(tencent_server.port), "http"
+    for i in range(3):
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(engine.run, "line {}".format(i)).result() == "译:line {}".format(i)
+    assert engine.run_batch(["a", "b"]) == ["译:a", "译:b"]
+    assert len(tencent_server.connections) == 4
+    assert len(set(tencent_server.connections)) == 1
+
+
+def test_gpt_reset_clears_only_the_given_language():
+    from engine_translation.gpt import GPT
+    engine = GPT(key="key", base_url="http://127.0.0.1:9")
+    for language in ("中文", "英语"):
+        engine.context(language).add({"role": "user", "content": "a"}, {"role": "assistant", "content": language})
+    engine.reset("中文")
+    assert list(engine.contexts) == ["英语"]
+    assert len(engine.context("英语").turns) == 1
+    engine.reset()
+    assert engine.contexts == {}
@@ -0,0 +1,74 @@
+import pysubs2
+import pytest
+
+from srt2ass import STYLE_DICT, AssWriter, srt2ass
+
+SEGMENTS = [
+    {"start": 0.0, "end": 1.5, "text": " こんにちは 世界", "words": []},
+    {"start": 1.5, "end": 3.256, "text": " 今日は とても いい天気ですね 本当に", "words": []},
+    {"start": 3.256, "end": 4.0, "text": "two\nlines {\\i1}italic{\\i0}", "words": []},
+    {"start": 4.0, "end": 3661.001, "text": " 2024 年 12345 ＡＢＣＤＥ", "words": []},
+]
+
+# 改成流式转换之前的srt2ass对pysubs2保存的SEGMENTS字幕的输出（去掉文件头）
+EXPECTED = {
+    (False, "Modest"):
+        "Dialogue: 0,0:00:00.00,0:00:01.50,default,,0,0,0,,こんにちは 世界\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,今日は とても いい天気ですね 本当に\n"
+        "Dialogue: 0,0:00:03.25,0:00:04.00,default,,0,0,0,,two\nlines <i>italic</i>\n"
+        "Dialogue: 0,0:00:04.00,1:01:01.00,default,,0,0,0,,2024 年 12345 ＡＢＣＤＥ\n",
+    (True, "Modest"):
+        "Dialogue: 0,0:00:00.00,0:00:01.50,default,,0,0,0,,こんにちは 世界\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,今日は とても(adjust_required)\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,いい天気ですね 本当に(adjust_required)\n"
+        "Dialogue: 0,0:00:03.25,0:00:04.00,default,,0,0,0,,two\nlines <i>italic</i>\n"
+        "Dialogue: 0,0:00:04.00,1:01:01.00,default,,0,0,0,,2024 年 12345 ＡＢＣＤＥ\n",
+    (True, "Aggressive"):
+        "Dialogue: 0,0:00:00.00,0:00:01.50,default,,0,0,0,,こんにちは(adjust_required)\n"
+        "Dialogue: 0,0:00:00.00,0:00:01.50,default,,0,0,0,,世界(adjust_required)\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,今日は(adjust_required)\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,とても(adjust_required)\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,いい天気ですね(adjust_required)\n"
+        "Dialogue: 0,0:00:01.50,0:00:03.25,default,,0,0,0,,本当に(adjust_required)\n"
+        "Dialogue: 0,0:00:03.25,0:00:04.00,default,,0,0,0,,two\nlines <i>italic</i>\n"
+        "Dialogue: 0,0:00:04.00,1:01:01.00,default,,0,0,0,,2024 年 12345 ＡＢＣＤＥ\n",
+}
+SPLITS = list(EXPECTED)
+
+
+def expected_bytes(is_split, split_method, bom=""):
+    return (bom + STYLE_DICT["head_str_default"] + "\n" + EXPECTED[(is_split, split_method)]).encode("utf8")
+
+
+@pytest.fixture
+def srt_text(tmp_path):
+    path = tmp_path / "pysubs2.srt"
+    pysubs2.load_from_whisper(SEGMENTS).save(str(path))
+    return path.read_text(encoding="utf-8")
+
+
+@pytest.mark.parametrize("is_split,split_method", SPLITS)
+@pytest.mark.parametrize("encoding,newline,bom", [
+    ("utf-8", "\n", ""),
+    ("utf-8", "\r\n", ""),
+    ("utf-8-sig", "\n", "\ufeff"),
+    # utf-16的BOM在解码时就被去掉了，输出不带BOM
+    ("utf-16", "\r\n", ""),
+    ("gbk", "\n", ""),
+])
+def test_srt2ass_matches_previous_output(tmp_path, srt_text, is_split, split_method, encoding, newline, bom):
+    path = tmp_path / "input.srt"
+    path.write_bytes(srt_text.replace("\n", newline).encode(encoding))
+    output = srt2ass(str(path), "default", is_split, split_method)
+    assert output == str(tmp_path / "input.ass").replace("\\", "\\\\").replace("/", "//")
+    assert (tmp_path / "input.ass").read_bytes() == expected_bytes(is_split, split_method, bom)
+
+
+@pytest.mark.parametrize("is_split,split_method", SPLITS)
+def test_ass_writer_streaming_matches_previous_output(tmp_path, srt_text, is_split, split_method):
+    path = tmp_path / "streamed.ass"
+    with AssWriter(str(path), "default", is_split, split_method) as writer:
+        for line in srt_text.split("\n"):
+            writer.write_line(line)
+            writer.flush()
+    assert path.read_bytes() == expected_bytes(is_split, split_method)
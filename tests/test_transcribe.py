@@ -0,0 +1,278 @@
+import numpy as np
+import pytest
+
+from transcribe import iter_chunks
+
+
+def speech_like(seconds, sample_rate=16000, seed=0):
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 0.1, int(seconds * sample_rate)).astype(np.float32)
+    # 每2秒一段0.3秒的静音，作为可选的切分点
+    for start in range(0, len(audio), 2 * sample_rate):
+        audio[start:start + int(0.3 * sample_rate)] = 0
+    return audio
+
+
+@pytest.mark.parametrize("chunk_duration,search_duration", [(10, 3), (2, 5), (0.5, 30)])
+def test_iter_chunks_covers_audio_exactly(chunk_duration, search_duration):
+    audio = speech_like(30)
+    blocks = np.array_split(audio, 7)
+    chunks = list(iter_chunks(blocks, chunk_duration=chunk_duration, search_duration=search_duration))
+    offsets = [offset for offset, _ in chunks]
+    assert offsets == sorted(offsets)
+    assert all(len(chunk) > 0 for _, chunk in chunks)
+    assert np.array_equal(np.concatenate([chunk for _, chunk in chunks]), audio)
+    for offset, chunk in chunks:
+        assert np.array_equal(audio[offset:offset + len(chunk)], chunk)
+
+
+def test_iter_chunks_rejects_invalid_durations():
+    with pytest.raises(ValueError):
+        list(iter_chunks([np.zeros(16000, dtype=np.float32)], chunk_duration=0))
+    with pytest.raises(ValueError):
+        list(iter_chunks([np.zeros(16000, dtype=np.float32)], search_duration=-1))
+
+
+def test_is_block_iterator():
+    import io
+    from transcribe import is_block_iterator
+    block = np.zeros(16000, dtype=np.float32)
+    assert is_block_iterator([block])
+    assert is_block_iterator(iter([block]))
+    assert is_block_iterator(b for b in [block])
+    for audio in ("a.wav", b"RIFF....", bytearray(b"RIFF"), memoryview(b"RIFF"), io.BytesIO(b"RIFF"), block):
+        assert not is_block_iterator(audio)
+
+
+class FakeBatchedPipeline:
+    """
+    不加载模型的批量推理：每个片段返回一个覆盖整个片段的分段，文本为片段在拼接音频中的起始时间
+    """
+    calls = []
+
+    def __init__(self, model=None):
+        pass
+
+    def transcribe(self, audio, clip_timestamps=None, **params):
+        import types
+        self.calls.append(clip_timestamps)
+        segments = (types.SimpleNamespace(start=clip["start"], end=clip["end"], text="{:.3f}".format(clip["start"]), words=[])
+                    for clip in clip_timestamps)
+        return segments, None
+
+
+def test_run_batch_splits_segments_back_per_file(tmp_path, monkeypatch):
+    import pysubs2
+    import transcribe
+    from transcribe import SAMPLE_RATE, Transcribe, clip_timestamps
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    monkeypatch.setattr(transcribe, "BatchedInferencePipeline", FakeBatchedPipeline)
+    FakeBatchedPipeline.calls.clear()
+    files = [("a.wav", speech_like(10, seed=1)), ("b.wav", speech_like(45, seed=2)), ("c.wav", speech_like(5, seed=3))]
+    model = Transcribe.__new__(Transcribe)
+    model.model = None
+    results = list(model.run_batch(files, batch_size=8))
+    assert [file_name for file_name, _, _ in results] == ["a.wav", "b.wav", "c.wav"]
+    offset = 0.0
+    for (file_name, audio), (_, srt, _) in zip(files, results):
+        expected = [(start / SAMPLE_RATE, end / SAMPLE_RATE) for start, end in clip_timestamps(audio)]
+        subs = pysubs2.load(srt)
+        # 时间换算回文件内，文本中是拼接音频中的绝对时间
+        assert [(line.start, line.end) for line in subs] == [(round(s * 1000), round(e * 1000)) for s, e in expected]
+        assert [float(line.text) for line in subs] == pytest.approx([offset + s for s, _ in expected], abs=1e-3)
+        offset += len(audio) / SAMPLE_RATE
+    # 三个文件凑在一次批量推理中
+    assert len(FakeBatchedPipeline.calls) == 1
+
+
+SEGMENTS = [
+    {"start": 0.0, "end": 1.5, "text": " {\\an8}こんにちは 世界", "words": []},
+    {"start": 1.5, "end": 3.25, "text": "two\nlines {\\i1}italic{\\i0}", "words": []},
+    {"start": 3.25, "end": 4.0, "text": "  ", "words": []},
+    {"start": 4.0, "end": 61.001, "text": "これは テスト です 12345", "words": []},
+]
+
+
+@pytest.mark.parametrize("is_split,split_method", [(False, "Modest"), (True, "Modest"), (True, "Aggressive")])
+def test_stream_writes_the_same_files_as_run(tmp_path, monkeypatch, is_split, split_method):
+    from transcribe import Transcribe
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    model = Transcribe.__new__(Transcribe)
+    model._segments = lambda *args: iter(SEGMENTS)
+    model.run("ran.wav", is_split=is_split, split_method=split_method)
+    streamed = list(model.stream("streamed.wav", is_split=is_split, split_method=split_method))
+    assert [segment["text"] for segment in streamed] == [segment["text"] for segment in SEGMENTS]
+    for ext in ("srt", "ass"):
+        assert (tmp_path / "temp" / ("streamed." + ext)).read_bytes() == (tmp_path / "temp" / ("ran." + ext)).read_bytes()
+
+
+class StubModel:
+    """
+    记录调用次数的WhisperModel替身：每次转录返回一个覆盖整段音频的分段
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def transcribe(self, audio, **params):
+        import types
+        self.calls += 1
+        duration = len(audio) / 16000 if isinstance(audio, np.ndarray) else 1.0
+        word = types.SimpleNamespace(start=0.0, end=duration, word=" hello", probability=0.9)
+        segments = iter([types.SimpleNamespace(start=0.0, end=duration, text=" hello", words=[word])])
+        return segments, types.SimpleNamespace(duration=duration)
+
+
+def write_wav(path, audio, sample_rate=16000):
+    import wave
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def test_segment_cache_skips_model_until_a_key_param_changes(tmp_path, monkeypatch):
+    from transcribe import SegmentCache, Transcribe
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    write_wav(tmp_path / "a.wav", speech_like(3, seed=1))
+    write_wav(tmp_path / "b.wav", speech_like(3, seed=2))
+    model = Transcribe.__new__(Transcribe)
+    model.model = StubModel()
+    model.model_name = "small"
+    model.compute_type = "int8"
+    model.num_workers = 1
+    model.cache = SegmentCache(str(tmp_path / "cache"))
+
+    model.run("a.wav")
+    assert model.model.calls == 1
+    first = (tmp_path / "temp" / "a.srt").read_bytes()
+    # 同样的音频和参数：直接读缓存，字幕内容不变
+    model.run("a.wav")
+    assert model.model.calls == 1
+    assert (tmp_path / "temp" / "a.srt").read_bytes() == first
+    # 只影响字幕生成的参数不参与key
+    model.run("a.wav", is_split=True, sub_style="default")
+    assert model.model.calls == 1
+
+    calls = model.model.calls
+    for file_name, params in [("b.wav", {}),
+                              ("a.wav", dict(language="en")),
+                              ("a.wav", dict(beam_size=1)),
+                              ("a.wav", dict(is_vad_filter=True)),
+                              ("a.wav", dict(is_vad_filter=True, min_silence_duration_ms=200)),
+                              ("a.wav", dict(initial_prompt="prompt")),
+                              ("a.wav", dict(is_parallel=True)),
+                              ("a.wav", dict(is_parallel=True, chunk_duration=1))]:
+        model.run(file_name, **params)
+        assert model.model.calls > calls, (file_name, params)
+        calls = model.model.calls
+        # 第二次相同的参数命中
+        model.run(file_name, **params)
+        assert model.model.calls == calls, (file_name, params)
+
+    for attr, value in [("model_name", "medium"), ("compute_type", "float16")]:
+        monkeypatch.setattr(model, attr, value)
+        model.run("a.wav")
+        assert model.model.calls == calls + 1, attr
+        calls = model.model.calls
+    # use_cache=False时总是调用模型
+    model.run("a.wav", use_cache=False)
+    assert model.model.calls == calls + 1
+
+
+class StubWhisperModel(StubModel):
+    """
+    autotune用的WhisperModel替身：int8_float32不可用，其余计算类型中num_workers越多越快
+    """
+    def __init__(self, model_name, device, compute_type, cpu_threads, num_workers):
+        super().__init__()
+        if compute_type == "int8_float32":
+            raise ValueError("unsupported compute type")
+        self.num_workers = num_workers
+
+    def transcribe(self, audio, **params):
+        import time
+        time.sleep(0.02 / self.num_workers)
+        return super().transcribe(audio, **params)
+
+
+class StubModelPool:
+    def __init__(self):
+        self.calls = []
+
+    def get(self, model_name, device, compute_type, cpu_threads=0, num_workers=1):
+        self.calls.append(dict(compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers))
+        return StubModel()
+
+
+def test_autotune_persists_and_is_applied_to_unset_params(tmp_path, monkeypatch):
+    import transcribe
+    from transcribe import Transcribe, autotune, load_autotune
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transcribe, "WhisperModel", StubWhisperModel)
+    monkeypatch.setattr(transcribe.os, "cpu_count", lambda: 4)
+    best = autotune("small", speech_like(1), compute_types=("int8", "int8_float32"))
+    assert (best["compute_type"], best["cpu_threads"], best["num_workers"]) == ("int8", 1, 4)
+    assert load_autotune("small") == best
+    assert load_autotune("medium") is None
+    # 再调优另一个模型时保留已有的结果
+    autotune("medium", speech_like(1), compute_types=("int8",))
+    assert load_autotune("small") == best
+
+    pool = StubModelPool()
+    monkeypatch.setattr(transcribe, "model_pool", pool)
+    for cpu_threads, num_workers, expected in [(0, 1, (1, 4)), (2, 1, (2, 4)), (0, 3, (1, 3)), (2, 3, (2, 3))]:
+        model = Transcribe("small", device="cpu", cpu_threads=cpu_threads, num_workers=num_workers)
+        assert (pool.calls[-1]["cpu_threads"], pool.calls[-1]["num_workers"]) == expected
+        assert pool.calls[-1]["compute_type"] == model.compute_type == "int8"
+    # 没有调优过的模型使用默认配置
+    Transcribe("large", device="cpu")
+    assert pool.calls[-1] == dict(compute_type="float32", cpu_threads=0, num_workers=1)
+
+
+@pytest.mark.parametrize("content", ["{\"truncated\": ", "[1, 2]", "{\"host\": 1}", "\xff\xfe"])
+def test_corrupt_autotune_file_is_retuned(tmp_path, monkeypatch, content):
+    import transcribe
+    from transcribe import autotune, load_autotune
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transcribe, "WhisperModel", StubWhisperModel)
+    monkeypatch.setattr(transcribe, "host_id", lambda: "host")
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "autotune.json").write_bytes(content.encode("latin-1"))
+    assert load_autotune("small") is None
+    best = autotune("small", speech_like(1), compute_types=("int8",))
+    assert load_autotune("small") == best
+
+
+def test_parallel_transcribe_bounds_outstanding_chunks(monkeypatch):
+    import time
+    import transcribe
+    from transcribe import Transcribe
+
+    class SlowModel(StubModel):
+        def transcribe(self, audio, **params):
+            time.sleep(0.01)
+            return super().transcribe(audio, **params)
+
+    segments = []
+    ahead = []
+
+    def iter_chunks(*args, **kwargs):
+        # 每切出一个分块，记录已切出但还没有返回分段的分块数
+        for i, chunk in enumerate(transcribe.iter_chunks.__wrapped__(*args, **kwargs)):
+            ahead.append(i - len(segments))
+            yield chunk
+
+    iter_chunks.__wrapped__ = transcribe.iter_chunks
+    monkeypatch.setattr(transcribe, "iter_chunks", iter_chunks)
+    model = Transcribe.__new__(Transcribe)
+    model.model = SlowModel()
+    model.num_workers = 2
+    # 音频读取远快于转录
+    for segment in model._transcribe_parallel((speech_like(1, seed=i) for i in range(40)), {}, chunk_duration=1):
+        segments.append(segment)
+    assert len(segments) == model.model.calls == len(ahead) >= 20
+    assert max(ahead) <= 2 * model.num_workers - 1
@@ -0,0 +1,350 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import translation as tr
+
+
+class FakeEngine:
+    """
+    不联网的翻译引擎：译文为"语言:原文"，记录调用和同时在途的最大请求数
+    """
+    def __init__(self, max_concurrency=2, delay=0.02, sequential=False):
+        self.qps = None
+        self.max_concurrency = max_concurrency
+        self.sequential = sequential
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.calls = []
+        self.resets = []
+
+    def reset(self, target_language=None):
+        self.resets.append(target_language)
+
+    def _request(self, texts, target_language):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.calls.append((tuple(texts), target_language))
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return ["{}:{}".format(target_language, text) for text in texts]
+
+    def run(self, text, target_language="中文"):
+        return self._request([text], target_language)[0]
+
+    def run_batch(self, texts, target_language="中文"):
+        return self._request(texts, target_language)
+
+
+def test_concurrency_cap_is_per_engine():
+    engine = FakeEngine(max_concurrency=2)
+    texts = ["line {}".format(i) for i in range(40)]
+    # 两个实例各自配置了更多的工作线程，同时翻译
+    instances = [tr.translation(engine, max_concurrency=8, memory_path=None) for _ in range(2)]
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(lambda t: t.translate_lines(texts, batch_size=2), instances))
+    assert results[0] == ["中文:" + text for text in texts]
+    assert engine.peak <= 2
+
+
+def test_sequential_engine_sends_batches_in_order():
+    engine = FakeEngine(max_concurrency=4, sequential=True)
+    texts = ["line {}".format(i) for i in range(30)]
+    t = tr.translation(engine, memory_path=None)
+    assert t.workers() == 1
+    t.translate_lines(texts, batch_size=3)
+    sent = [text for batch, _ in engine.calls for text in batch]
+    assert sent == texts
+    assert engine.peak == 1
+
+
+def test_memory_keys_by_language_code(tmp_path):
+    from translation_memory import TranslationMemory
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    memory.put_many(["こんにちは"], ["你好"], "GPT", "中文", model="m")
+    assert memory.get_many(["こんにちは"], "GPT", "zh", model="m") == ["你好"]
+    assert memory.get_many(["こんにちは"], "GPT", " ZH ", model="m") == ["你好"]
+    memory.close()
+
+
+def test_memory_migrates_display_name_rows(tmp_path):
+    import sqlite3
+    from translation_memory import TranslationMemory
+    path = str(tmp_path / "memory.db")
+    TranslationMemory(path).close()
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT INTO memory (engine, model, source_language, target_language, source_text, target_text) "
+                 "VALUES ('GPT', 'm', 'auto', '英语', 'おはよう', 'good morning')")
+    conn.commit()
+    conn.close()
+    memory = TranslationMemory(path)
+    assert memory.get_many(["おはよう"], "GPT", "en", model="m") == ["good morning"]
+    memory.close()
+
+
+def test_import_ass_splits_at_last_line_break(tmp_path):
+    import pysubs2
+    from translation_memory import TranslationMemory
+    subs = pysubs2.SSAFile()
+    subs.append(pysubs2.SSAEvent(start=0, end=1000, text=r"一行目\N二行目\N第一行 第二行"))
+    subs.append(pysubs2.SSAEvent(start=1000, end=2000, text="no translation"))
+    path = str(tmp_path / "bilingual.ass")
+    subs.save(path)
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    assert memory.import_ass(path, "GPT", "中文", model="m") == 1
+    assert memory.get_many([r"一行目\N二行目"], "GPT", "zh", model="m") == ["第一行 第二行"]
+    memory.close()
+
+
+def test_merge_sentences_stops_at_endings_gaps_and_char_limit():
+    texts = ["今日は", "いい天気", "ですね。", "明日は", "雨", "かな"]
+    starts = [0.0, 1.5, 3.0, 4.0, 6.0, 7.75]
+    ends = [1.0, 2.5, 3.8, 5.0, 7.0, 9.0]
+    # 句末标点后、间隔超过 max_gap 时另起一句，间隔正好等于 max_gap 时合并
+    assert tr.merge_sentences(texts, starts, ends, max_gap=0.75) == [[0, 1, 2], [3], [4, 5]]
+    assert tr.merge_sentences(texts, starts, ends, max_gap=0.3) == [[0], [1], [2], [3], [4], [5]]
+    # 合并后正好 max_chars 字时合并，超过时另起一句
+    assert tr.merge_sentences(["abcdef", "ghij", "k"], [0, 1, 2], [1, 2, 3], max_chars=10) == [[0, 1], [2]]
+    # 空白的片段自成一组
+    assert tr.merge_sentences(["a", " ", "b"], [0, 1, 2], [1, 2, 3]) == [[0], [1], [2]]
+
+
+def test_sentence_merger_returns_groups_as_they_close():
+    merger = tr.SentenceMerger(max_gap=0.8, max_chars=120)
+    assert merger.add("これは", 0.0, 1.0) is None
+    assert merger.add("テスト", 1.2, 2.0) is None
+    assert merger.add("次の文", 5.0, 6.0) == [0, 1]
+    assert merger.flush() == [2]
+    assert merger.flush() is None
+
+
+def test_split_translation_cuts_in_proportion_to_weights():
+    assert tr.split_translation("一二三四五六七八", [3, 1]) == ["一二三四五六", "七八"]
+    assert tr.split_translation("aaaa bbbb cccc dddd", [1, 1, 1, 1]) == ["aaaa", "bbbb", "cccc", "dddd"]
+    # 切点挪到附近的标点之后
+    assert tr.split_translation("你好，世界和平啊", [1, 1]) == ["你好，", "世界和平啊"]
+    # 权重都为 0 时平均切分
+    assert tr.split_translation("abcd", [0, 0]) == ["ab", "cd"]
+    assert tr.split_translation("abcd", [5]) == ["abcd"]
+
+
+@pytest.mark.parametrize("text,weights", [("好", [1, 1, 1]), ("", [1, 2]), ("ab", [1, 1, 1, 1, 1])])
+def test_split_translation_shorter_than_pieces_leaves_empty_cues(text, weights):
+    pieces = tr.split_translation(text, weights)
+    # 每一行都有译文（可能为空字符串），文字不丢失也不重复
+    assert len(pieces) == len(weights)
+    assert all(isinstance(piece, str) for piece in pieces)
+    assert "".join(pieces) == text
+
+
+def test_redistribute_maps_pieces_back_to_lines():
+    groups = [[0, 1], [2], [3, 4, 5]]
+    results = tr.redistribute(groups, ["今日は晴れ", "x", "好"], [1, 1, 1, 1, 1, 1], 6)
+    assert results == ["今日", "は晴れ", "x", "", "好", ""]
+
+
+class FailingEngine(FakeEngine):
+    """
+    每次请求都返回认证错误的主引擎
+    """
+    def _request(self, texts, target_language):
+        error = Exception("auth")
+        error.status_code = 401
+        raise error
+
+
+def test_fallback_translations_are_remembered_under_the_answering_engine(tmp_path):
+    from translation_memory import TranslationMemory
+    primary, secondary = FailingEngine(), FakeEngine()
+    t = tr.translation(primary, memory_path=str(tmp_path / "memory.db"), secondary=secondary)
+    journal = tr.TranslationJournal(str(tmp_path / "out.journal.jsonl"), {"source": "x"})
+    texts = ["a", "b", "c"]
+    assert t.translate_lines(texts, batch_size=2, journal=journal) == ["中文:a", "中文:b", "中文:c"]
+    memory = TranslationMemory(str(tmp_path / "memory.db"))
+    assert memory.get_many(texts, secondary, "中文") == ["中文:a", "中文:b", "中文:c"]
+    assert memory.get_many(texts, primary, "中文") == [None, None, None]
+    memory.close()
+    with open(str(tmp_path / "out.journal.jsonl"), encoding="utf-8") as f:
+        assert all('"engine": "FakeEngine"' in line for line in f.read().splitlines()[1:])
+
+
+class InterruptedEngine(FakeEngine):
+    """
+    第 interrupt_at 次请求时模拟用户按下 Ctrl+C
+    """
+    def __init__(self, interrupt_at, **kwargs):
+        super().__init__(**kwargs)
+        self.interrupt_at = interrupt_at
+        self.attempts = 0
+
+    def _request(self, texts, target_language):
+        self.attempts += 1
+        if self.attempts == self.interrupt_at:
+            raise KeyboardInterrupt
+        return super()._request(texts, target_language)
+
+
+def test_interrupted_translation_resumes_from_journal(tmp_path):
+    path = str(tmp_path / "out.journal.jsonl")
+    texts = ["line {}".format(i) for i in range(30)]
+    engine = InterruptedEngine(4, sequential=True)
+    t = tr.translation(engine, memory_path=None)
+    with pytest.raises(KeyboardInterrupt):
+        t.translate_lines(texts, batch_size=3, journal=tr.TranslationJournal(path, {"source": "x"}))
+    # 中断后排队的批次被取消，最多还有一批在取消前已经被工作线程取走
+    assert engine.attempts <= 5
+
+    engine = FakeEngine(sequential=True)
+    t = tr.translation(engine, memory_path=None)
+    results = t.translate_lines(texts, batch_size=3, journal=tr.TranslationJournal(path, {"source": "x"}))
+    assert results == ["中文:" + text for text in texts]
+    # 只请求中断前没有译完的行
+    assert [text for batch, _ in engine.calls for text in batch] == texts[9:]
+
+    # 设置不同时不使用旧的进度
+    engine = FakeEngine(sequential=True)
+    t = tr.translation(engine, memory_path=None)
+    t.translate_lines(texts, batch_size=3, journal=tr.TranslationJournal(path, {"source": "y"}))
+    assert [text for batch, _ in engine.calls for text in batch] == texts
+
+
+def test_circuit_breaker_half_open_allows_a_single_probe():
+    breaker = tr.CircuitBreaker(failure_threshold=2, reset_timeout=0.05, probe_wait=0.01)
+    breaker.record_failure()
+    assert breaker.acquire() == 0
+    breaker.record_failure()
+    assert breaker.acquire() > 0
+    time.sleep(0.06)
+    # 半开：只有第一个请求获得试探资格
+    assert breaker.acquire() == 0
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(breaker.acquire).result() == 0.01
+    # 试探失败，重新断开
+    breaker.record_failure()
+    assert breaker.acquire() > 0.01
+    time.sleep(0.06)
+    assert breaker.acquire() == 0
+    breaker.record_success()
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(breaker.acquire).result() == 0
+
+
+def test_hedge_pool_is_shared_between_instances():
+    t1 = tr.translation(FakeEngine(), memory_path=None, secondary=FakeEngine(), hedge=True)
+    t2 = tr.translation(FakeEngine(), memory_path=None, secondary=FakeEngine(), hedge=True)
+    assert t1.call("run", "x") == ("中文:x", t1.engine)
+    assert t2.call("run", "y") == ("中文:y", t2.engine)
+    assert not hasattr(t1, "hedge_pool")
+
+
+def test_transcribe_translate_save_with_split_lines_translates_once(tmp_path, monkeypatch):
+    import types
+    import pysubs2
+    from transcribe import Transcribe
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    segments = [
+        {"start": 0.0, "end": 2.0, "text": "これは テスト です", "words": []},
+        {"start": 2.0, "end": 3.0, "text": "はい", "words": []},
+        {"start": 3.0, "end": 5.0, "text": "空白で 分ける", "words": []},
+    ]
+    # 不加载模型，直接用 Transcribe.stream 写字幕并产出分段
+    fake = types.SimpleNamespace(_segments=lambda *args: iter(segments))
+    stream = Transcribe.stream(fake, "clip.wav", is_split=True, split_method="Aggressive")
+    engine = FakeEngine()
+    t = tr.translation(engine, memory_path=None)
+    ass_path, _ = t.transcribe_translate_save(stream, "./temp/clip.ass", batch_size=1)
+    source = pysubs2.load("./temp/clip.ass")
+    assert len(source) > len(segments)
+    # 只按分段翻译了一遍，没有按拆开的行重新翻译
+    assert sorted(text for batch, _ in engine.calls for text in batch) == sorted(s["text"] for s in segments)
+    bilingual = pysubs2.load(ass_path)
+    assert len(bilingual) == len(source)
+    assert [line.text.split(r"\N")[0] for line in bilingual] == [line.text for line in source]
+    assert [line.text.split(r"\N")[1] for line in bilingual if line.start == 2000] == ["中文:はい"]
+    # 分段的译文按字数拆到它的各行上
+    pieces = [line.text.split(r"\N")[1] for line in bilingual if line.start == 0]
+    assert len(pieces) == 3
+    assert "".join(pieces).replace(" ", "") == "中文:これはテストです"
+
+
+class ThreadRecordingEngine(FakeEngine):
+    """
+    另外记录发出请求的线程
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = set()
+
+    def _request(self, texts, target_language):
+        self.threads.add(threading.get_ident())
+        return super()._request(texts, target_language)
+
+
+def write_subtitles(path, texts):
+    import pysubs2
+    subs = pysubs2.SSAFile()
+    for i, text in enumerate(texts):
+        subs.append(pysubs2.SSAEvent(start=i * 1000, end=i * 1000 + 900, text=text))
+    subs.save(str(path))
+
+
+def test_translate_save_multi_shares_one_request_pool(tmp_path, monkeypatch):
+    import pysubs2
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    texts = ["line {}".format(i) for i in range(24)]
+    write_subtitles(tmp_path / "clip.ass", texts)
+    engine = ThreadRecordingEngine(max_concurrency=2)
+    t = tr.translation(engine, memory_path=str(tmp_path / "memory.db"))
+    languages = ["中文", "英语", "意大利语", "Português (BR)"]
+    outputs = t.translate_save_multi("clip.ass", languages, keep_origin=False, batch_size=3)
+    # 所有语言的请求都由同一个线程池中的 2 个线程发出
+    assert len(engine.threads) <= 2
+    assert engine.peak <= 2
+    assert len({ass for ass, _ in outputs.values()}) == len(languages)
+    for language, (ass, _) in outputs.items():
+        assert [line.text for line in pysubs2.load(ass)] == ["{}:{}".format(language, text) for text in texts]
+
+
+def test_translate_save_multi_runs_one_ordered_lane_per_language(tmp_path, monkeypatch):
+    import pysubs2
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    texts = ["line {}".format(i) for i in range(24)]
+    write_subtitles(tmp_path / "clip.ass", texts)
+    engine = FakeEngine(max_concurrency=2, sequential=True)
+    t = tr.translation(engine, memory_path=None)
+    languages = ["中文", "英语", "意大利语"]
+    outputs = t.translate_save_multi("clip.ass", languages, keep_origin=False, batch_size=3)
+    # 同一语言的批次按顺序逐个发送，不同语言同时翻译，但不超过 max_concurrency
+    for language in languages:
+        assert [text for batch, target in engine.calls if target == language for text in batch] == texts
+    assert engine.peak == 2
+    # 每个语言只清空自己的上下文
+    assert sorted(engine.resets) == sorted(languages)
+    for language, (ass, _) in outputs.items():
+        assert [line.text for line in pysubs2.load(ass)] == ["{}:{}".format(language, text) for text in texts]
+
+
+def test_translation_memory_is_keyed_per_language(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    texts = ["a", "b", "a"]
+    write_subtitles(tmp_path / "clip.ass", texts)
+    engine = FakeEngine()
+    t = tr.translation(engine, memory_path=str(tmp_path / "memory.db"))
+    t.translate_save_multi("clip.ass", ["中文", "英语"], batch_size=1)
+    # 每种语言各翻译一次不重复的行
+    assert sorted(engine.calls) == sorted([(("a",), "中文"), (("b",), "中文"), (("a",), "英语"), (("b",), "英语")])
+    engine.calls.clear()
+    t.translate_save_multi("clip.ass", ["中文", "英语"], batch_size=1, resume=False)
+    # 第二次全部命中各自语言的翻译记忆
+    assert engine.calls == []
+    assert t.memory.get_many(["a"], engine, "英语") == ["英语:a"]
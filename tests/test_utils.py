@@ -0,0 +1,246 @@
+import os
+import shutil
+import subprocess
+import wave
+
+import ffmpeg
+
+import numpy as np
+import pytest
+
+from utils import AudioStore, hardsub_parallel, media_duration, merge_subtitles_to_video, mux_subtitles, prune_cache, store_key
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="需要ffmpeg")
+
+
+def write_wav(path, seconds, sample_rate=16000, seed=0):
+    data = (np.random.default_rng(seed).uniform(-0.5, 0.5, int(seconds * sample_rate)) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(data.tobytes())
+    return str(path)
+
+
+def test_prune_cache_removes_least_recently_used(tmp_path):
+    for i, name in enumerate(["old", "mid", "new"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "a").write_bytes(b"x" * 100)
+    os.utime(tmp_path / "dir", (999, 999))
+    (tmp_path / "writing.part").write_bytes(b"x" * 100)
+
+    assert prune_cache(str(tmp_path), 300, keep=[str(tmp_path / "old")]) == 2
+    assert sorted(os.listdir(tmp_path)) == ["new", "old", "writing.part"]
+    assert prune_cache(str(tmp_path), None) == 0
+
+
+@needs_ffmpeg
+def test_audio_store_evicts_over_budget(tmp_path):
+    first = write_wav(tmp_path / "a.wav", 1, seed=1)
+    second = write_wav(tmp_path / "b.wav", 1, seed=2)
+    # 每个数据文件 1秒 * 16000 * 4字节 = 64000字节，预算只够放一个
+    store = AudioStore(str(tmp_path / "store"), max_bytes=100000)
+    first_path = store.path(first)
+    second_path = store.path(second)
+    assert os.path.exists(second_path)
+    assert not os.path.exists(first_path)
+    assert len(os.listdir(tmp_path / "store")) == 1
+
+
+@needs_ffmpeg
+def test_store_key_uses_source_hash(tmp_path):
+    media = write_wav(tmp_path / "a.wav", 1)
+    store = AudioStore(str(tmp_path / "store"))
+    audio = store.get(media)
+    key = store_key(audio)
+    assert key == f"{store._hash(media)}_16000_1"
+    assert store_key(store.get(media, 16000, 2)) == f"{store._hash(media)}_16000_2"
+    # 切片和普通数组不能用源文件哈希代表
+    assert store_key(audio[100:]) is None
+    assert store_key(np.array(audio)) is None
+
+
+def make_video(path, seconds=6, fps=25):
+    # 黑色画面加 440Hz 正弦音，每秒一个关键帧
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", f"color=c=black:s=160x120:r={fps}:d={seconds}",
+                    "-f", "lavfi", "-i", f"sine=f=440:d={seconds}:sample_rate=48000",
+                    "-c:v", "libx264", "-g", str(fps), "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", str(path)],
+                   check=True)
+    return str(path)
+
+
+def decode_frames(path, fps=25):
+    # 以视频流自己的起点为0，按时间戳以固定帧率取帧：时间戳跳变或重叠会表现为重复帧或丢帧
+    out = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-an",
+                          "-vf", f"setpts=PTS-STARTPTS,fps={fps}", "-f", "rawvideo", "-pix_fmt", "gray", "pipe:"],
+                         capture_output=True, check=True).stdout
+    return np.frombuffer(out, dtype=np.uint8).reshape(-1, 120, 160)
+
+
+def packet_times(path):
+    # 每个流的各个包按显示时间排序的 (pts, duration)，单位为流的时间基（重新编码后解码顺序可能不同，不比较dts）
+    out = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0", "-c", "copy",
+                          "-f", "framecrc", "-"], capture_output=True, check=True, text=True).stdout
+    streams = {}
+    for line in out.splitlines():
+        if not line.startswith("#"):
+            fields = [field.strip() for field in line.split(",")]
+            streams.setdefault(fields[0], []).append((int(fields[2]), int(fields[3])))
+    return {stream: sorted(packets) for stream, packets in streams.items()}
+
+
+def decode_audio(path):
+    out = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-vn", "-f", "s16le", "-ac", "1", "pipe:"],
+                         capture_output=True, check=True).stdout
+    return np.frombuffer(out, dtype="<i2")
+
+
+@needs_ffmpeg
+def test_media_duration_without_ffprobe(tmp_path, monkeypatch):
+    video = make_video(tmp_path / "in.mp4", seconds=3)
+    # 模拟没有安装ffprobe
+    monkeypatch.setattr(ffmpeg, "probe", lambda *args, **kwargs: (_ for _ in ()).throw(FileNotFoundError("ffprobe")))
+    assert media_duration(video) == pytest.approx(3, abs=0.1)
+
+
+@needs_ffmpeg
+def test_hardsub_parallel_keeps_duration_sync_and_subtitle_timing(tmp_path, monkeypatch):
+    import pysubs2
+    monkeypatch.chdir(tmp_path)
+    fps = 25
+    video = make_video(tmp_path / "in.mp4", fps=fps)
+    # 两个铺满画面的白色方块，分别跨过 3 段切分的切点（约 2 秒和 4 秒处）
+    subs = pysubs2.SSAFile()
+    subs.info["PlayResX"], subs.info["PlayResY"] = "160", "120"
+    box = r"{\an7\pos(0,0)\bord0\shad0\p1}m 0 0 l 160 0 160 120 0 120{\p0}"
+    shown = [(1.5, 2.5), (3.5, 4.5)]
+    for start, end in shown:
+        subs.append(pysubs2.SSAEvent(start=int(start * 1000), end=int(end * 1000), text=box))
+    subs.save(str(tmp_path / "boxes.ass"))
+    output = str(tmp_path / "out.mkv")
+    hardsub_parallel(video, "boxes.ass", output, segments=3, jobs=3, vcodec="libx264", preset="ultrafast")
+
+    assert media_duration(output) == pytest.approx(media_duration(video), abs=0.1)
+    # 音视频同步：与不切分、直接复制封装的结果相比，两个流每个包的时间戳都相同
+    remuxed = str(tmp_path / "remuxed.mkv")
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", video, "-c", "copy", remuxed], check=True)
+    assert packet_times(output) == packet_times(remuxed)
+    frames = decode_frames(output, fps)
+    assert len(frames) == len(decode_frames(video, fps)) == 6 * fps
+    for n, frame in enumerate(frames):
+        t = n / fps
+        if any(abs(t - edge) < 1.5 / fps for span in shown for edge in span):
+            continue
+        white = any(start <= t < end for start, end in shown)
+        assert (frame.mean() > 200) == white, "第 {} 帧（{:.2f} 秒）".format(n, t)
+    # 音频原样复制（mkv不裁掉AAC编码器的前置采样，所以与直接复制封装的结果比较）
+    assert np.array_equal(decode_audio(output), decode_audio(remuxed))
+
+
+def probe_streams(path):
+    # 解析 ffmpeg -i 的输出：[(流类型, 编码)]，附件为 ("Attachment", 文件名)
+    err = subprocess.run(["ffmpeg", "-hide_banner", "-i", path], capture_output=True, text=True).stderr
+    streams = []
+    for line in err.splitlines():
+        line = line.strip()
+        if line.startswith("Stream #"):
+            kind, codec = line.split(": ", 2)[1:3]
+            streams.append([kind, codec.split()[0].rstrip(",")])
+        elif line.startswith("filename") and streams and streams[-1][0] == "Attachment":
+            streams[-1][1] = line.split(":", 1)[1].strip()
+    return [tuple(stream) for stream in streams]
+
+
+def packet_hashes(path):
+    # 音视频每个流各个包的内容哈希，用来确认流是直接复制的
+    out = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0:v", "-map", "0:a?",
+                          "-c", "copy", "-f", "framemd5", "-"], capture_output=True, check=True, text=True).stdout
+    streams = {}
+    for line in out.splitlines():
+        if not line.startswith("#"):
+            fields = [field.strip() for field in line.split(",")]
+            streams.setdefault(fields[0], []).append(fields[-1])
+    return streams
+
+
+def video_start(path):
+    # 第一帧画面的显示时间（秒）
+    out = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0:v", "-c", "copy",
+                          "-f", "framecrc", "-"], capture_output=True, check=True, text=True).stdout
+    num, den = [line for line in out.splitlines() if line.startswith("#tb 0:")][0][6:].strip().split("/")
+    return min(int(line.split(",")[2]) for line in out.splitlines() if not line.startswith("#")) * int(num) / int(den)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("ext,codec", [(".mkv", "ass"), (".mp4", "mov_text")])
+def test_soft_subtitles_copy_streams_and_attach_fonts(tmp_path, ext, codec):
+    import pysubs2
+    video = make_video(tmp_path / "in.mp4", seconds=2)
+    subs = pysubs2.SSAFile()
+    subs.append(pysubs2.SSAEvent(start=500, end=1500, text="字幕テスト"))
+    subs.save(str(tmp_path / "sub.ass"))
+    (tmp_path / "fonts").mkdir()
+    (tmp_path / "fonts" / "dummy.ttf").write_bytes(b"\0\1\0\0" + b"x" * 100)
+    (tmp_path / "fonts" / "readme.txt").write_text("not a font")
+    output = str(tmp_path / ("out" + ext))
+    # 已有的输出文件被覆盖
+    (tmp_path / ("out" + ext)).write_bytes(b"old")
+    merge_subtitles_to_video(video, str(tmp_path / "sub.ass"), output, mode="soft", fonts=str(tmp_path / "fonts"))
+
+    expected = [("Video", "h264"), ("Audio", "aac"), ("Subtitle", codec)]
+    # 只有mkv附加字体，且只附加字体文件
+    if ext == ".mkv":
+        expected.append(("Attachment", "dummy.ttf"))
+    assert probe_streams(output) == expected
+    # 音视频直接复制，没有重新编码（与直接复制封装成同一格式的结果比较，mkv中AAC的前置采样信息不同）
+    remuxed = str(tmp_path / ("remuxed" + ext))
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", video, "-c", "copy", remuxed], check=True)
+    assert packet_hashes(output) == packet_hashes(remuxed)
+    srt = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", output, "-map", "0:s", "-f", "srt", "-"],
+                         capture_output=True, check=True, text=True).stdout
+    [event] = pysubs2.SSAFile.from_string(srt, format_="srt")
+    assert event.plaintext == "字幕テスト"
+    assert event.end - event.start == 1000
+    # 字幕相对画面的时间不变（mkv把所有流一起平移了AAC的前置采样时长）
+    assert event.start / 1000 - video_start(output) == pytest.approx(0.5, abs=0.002)
+
+
+@needs_ffmpeg
+def test_soft_subtitles_without_audio_or_fonts(tmp_path):
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi", "-i", "color=c=black:s=160x120:d=1",
+                    "-c:v", "libx264", "-pix_fmt", "yuv420p", str(tmp_path / "silent.mp4")], check=True)
+    (tmp_path / "sub.srt").write_text("1\n00:00:00,000 --> 00:00:00,800\nhello\n", encoding="utf-8")
+    output = str(tmp_path / "out.mkv")
+    mux_subtitles(str(tmp_path / "silent.mp4"), str(tmp_path / "sub.srt"), output, fonts=str(tmp_path / "missing"))
+    assert probe_streams(output) == [("Video", "h264"), ("Subtitle", "ass")]
+    with pytest.raises(ValueError):
+        mux_subtitles(str(tmp_path / "silent.mp4"), str(tmp_path / "sub.srt"), str(tmp_path / "out.avi"))
+
+
+@needs_ffmpeg
+def test_hardsub_parallel_falls_back_to_escaped_absolute_path(tmp_path, monkeypatch):
+    import pysubs2
+    # 模拟Windows上字幕与当前目录不在同一个盘：没有相对路径；目录名中带有滤镜参数的特殊字符
+    def relpath(path, start=None):
+        raise ValueError("path is on mount 'D:', start on mount 'C:'")
+    monkeypatch.setattr(os.path, "relpath", relpath)
+    work = tmp_path / "out: it's, [x]; y"
+    work.mkdir()
+    fps = 25
+    video = make_video(work / "in.mp4", seconds=2, fps=fps)
+    subs = pysubs2.SSAFile()
+    subs.info["PlayResX"], subs.info["PlayResY"] = "160", "120"
+    subs.append(pysubs2.SSAEvent(start=500, end=1500, text=r"{\an7\pos(0,0)\bord0\shad0\p1}m 0 0 l 160 0 160 120 0 120{\p0}"))
+    subs.save(str(work / "box.ass"))
+    output = str(work / "out.mkv")
+    hardsub_parallel(video, str(work / "box.ass"), output, segments=2, jobs=2, vcodec="libx264", preset="ultrafast")
+    frames = decode_frames(output, fps)
+    assert len(frames) == 2 * fps
+    # 每隔0.2秒取一帧（都不在字幕的起止时刻上），字幕时间内为白色
+    times = [n / fps for n in range(0, len(frames), 5)]
+    assert [frames[round(t * fps)].mean() > 200 for t in times] == [0.5 <= t < 1.5 for t in times]
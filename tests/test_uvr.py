@@ -0,0 +1,156 @@
+import os
+import shutil
+import wave
+
+import numpy as np
+import pytest
+
+pytest.importorskip("audio_separator")
+import uvr
+from utils import AudioStore
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="需要 ffmpeg")
+
+SAMPLE_RATE = 8000
+
+
+class FakeSeparator:
+    """
+    不加载模型的分离器：人声音轨原样复制输入，伴奏音轨为一半音量，返回 [伴奏, 人声]
+    """
+    def __init__(self, log_level=None, model_file_dir=None, output_dir=None, sample_rate=None):
+        self.output_dir = output_dir
+        self.calls = 0
+
+    def load_model(self, model_name):
+        pass
+
+    def separate(self, path):
+        self.calls += 1
+        base = os.path.splitext(os.path.basename(path))[0]
+        names = [base + "_(Instrumental).wav", base + "_(Vocals).wav"]
+        with wave.open(path, "rb") as f:
+            params, frames = f.getparams(), f.readframes(f.getnframes())
+        half = (np.frombuffer(frames, dtype="<i2") // 2).astype("<i2").tobytes()
+        for name, data in zip(names, [half, frames]):
+            with wave.open(os.path.join(self.output_dir, name), "wb") as f:
+                f.setparams(params)
+                f.writeframes(data)
+        return names
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(uvr, "Separator", FakeSeparator)
+    return uvr.UVR_Client(model_file_dir=str(tmp_path / "models"), output_dir=str(tmp_path / "temp"),
+                          sample_rate=SAMPLE_RATE, cache_dir=str(tmp_path / "cache"))
+
+
+def make_audio(path, seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 0.1, (int(seconds * SAMPLE_RATE), 2)).astype(np.float32)
+    uvr.write_wav(str(path), audio, SAMPLE_RATE)
+    return str(path)
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as f:
+        return np.frombuffer(f.readframes(f.getnframes()), dtype="<i2").reshape(-1, f.getnchannels()) / 32768
+
+
+# 窗口 4 秒、重叠 1 秒时窗口起点为 0、3、6、9 秒，覆盖最后一个窗口恰好装满、差一点装满、刚进入下一个窗口等情况
+@pytest.mark.parametrize("seconds", [2, 4, 6.5, 7, 7.9, 10, 10.5, 13])
+def test_chunked_separation_keeps_length(client, tmp_path, seconds):
+    audio = make_audio(tmp_path / "clip.wav", seconds)
+    store = AudioStore(str(tmp_path / "store"))
+    source = np.asarray(store.get(audio, SAMPLE_RATE, 2))
+    chunks = list(client.separate_stream(audio, window=4, overlap=1, audio_store=store))
+    assert sum(len(chunk) for chunk in chunks) == len(source)
+    output = read_wav(client.chunked_cache_path(audio, 4, 1, 1, False))
+    assert len(output) == len(source)
+    # 人声音轨与输入相同，交叉淡化后仍然与输入一致
+    assert np.allclose(output, source, atol=3 / 32768)
+
+
+def test_to_asr_blocks_matches_one_shot_resampling():
+    import soxr
+    t = np.arange(int(3.3 * SAMPLE_RATE)) / SAMPLE_RATE
+    audio = np.stack([np.sin(2 * np.pi * 440 * t)] * 2, axis=1).astype(np.float32) * 0.5
+    chunks = np.array_split(audio, 7)
+    blocks = np.concatenate(list(uvr.to_asr_blocks(chunks, SAMPLE_RATE)))
+    whole = soxr.resample(audio.mean(axis=1), SAMPLE_RATE, 16000)
+    assert abs(len(blocks) - len(whole)) <= 1
+    n = min(len(blocks), len(whole))
+    assert np.max(np.abs(blocks[:n] - whole[:n])) < 1e-3
+
+
+def speech_like(seconds, sample_rate, rng):
+    # 0.2 秒的音节之间有 0.15 秒的停顿
+    audio = rng.normal(0, 0.1, int(seconds * sample_rate)).astype(np.float32)
+    step = int(0.35 * sample_rate)
+    for start in range(0, len(audio), step):
+        audio[start + int(0.2 * sample_rate):start + step] *= 0.01
+    return audio
+
+
+def tone(seconds, sample_rate):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return (0.2 * np.sin(2 * np.pi * 440 * t) + 0.1 * np.sin(2 * np.pi * 880 * t)).astype(np.float32)
+
+
+def test_detect_music_finds_tone_and_steady_noise_but_not_speech():
+    rng = np.random.default_rng(0)
+    sr = 16000
+    audio = np.concatenate([speech_like(10, sr, rng), tone(10, sr), speech_like(10, sr, rng), np.zeros(5 * sr, np.float32),
+                            rng.normal(0, 0.05, 10 * sr).astype(np.float32), speech_like(5, sr, rng)])
+    regions = uvr.detect_music(audio, sr)
+    # 音调和持续的噪声（没有停顿）都判为音乐，语音和静音不算
+    assert len(regions) == 2
+    (s1, e1), (s2, e2) = regions
+    assert 9 <= s1 <= 10 and 20 <= e1 <= 21
+    assert 34 <= s2 <= 35 and 45 <= e2 <= 46
+    # 压在语音下面的背景音乐
+    assert uvr.detect_music(speech_like(10, sr, rng) + tone(10, sr) * 0.5, sr) == [(0.0, 10.0)]
+
+
+# 音乐区域的长度和位置不同，区域内的窗口在不同位置结束
+@pytest.mark.parametrize("before,music,after", [(6, 7, 6), (5, 9.7, 4), (0, 10, 6), (6, 10.3, 0)])
+def test_gated_separation_keeps_length_and_alignment(client, tmp_path, before, music, after):
+    rng = np.random.default_rng(1)
+    mono = np.concatenate([speech_like(before, SAMPLE_RATE, rng), tone(music, SAMPLE_RATE), speech_like(after, SAMPLE_RATE, rng)])
+    audio = str(tmp_path / "clip.wav")
+    uvr.write_wav(audio, np.stack([mono, mono], axis=1), SAMPLE_RATE)
+    store = AudioStore(str(tmp_path / "store"))
+    source = np.asarray(store.get(audio, SAMPLE_RATE, 2))
+    # stem=0 取半音量的伴奏音轨，分离过的区域与原始音频可以区分开
+    chunks = list(client.separate_stream(audio, window=4, overlap=1, audio_store=store, stem=0, gate=True))
+    assert sum(len(chunk) for chunk in chunks) == len(source)
+    output = read_wav(client.chunked_cache_path(audio, 4, 1, 0, True))
+    assert len(output) == len(source)
+    # 区域之外是原始音频，区域中间是分离结果
+    if before:
+        assert np.allclose(output[:int((before - 1) * SAMPLE_RATE)], source[:int((before - 1) * SAMPLE_RATE)], atol=3 / 32768)
+    middle = slice(int((before + 1) * SAMPLE_RATE), int((before + music - 1) * SAMPLE_RATE))
+    assert np.allclose(output[middle], source[middle] / 2, atol=3 / 32768)
+    if after:
+        tail = int((after - 1) * SAMPLE_RATE)
+        assert np.allclose(output[-tail:], source[-tail:], atol=3 / 32768)
+
+
+def test_separation_cache_is_pruned_by_last_use(client, tmp_path):
+    paths = [make_audio(tmp_path / "clip{}.wav".format(i), 2, seed=i) for i in range(3)]
+    first = client.infer(paths[0])
+    entry = os.path.getsize(first[0]) + os.path.getsize(first[1])
+    # 只放得下两个文件的分离结果
+    client.cache_max_bytes = int(entry * 2.5)
+    second = client.infer(paths[1])
+    os.utime(os.path.dirname(first[0]), (1, 1))
+    os.utime(os.path.dirname(second[0]), (2, 2))
+    # 命中缓存时更新最近使用时间，之后淘汰的是第二个文件的结果
+    calls = client.model.calls
+    assert client.infer(paths[0]) == first
+    assert client.model.calls == calls
+    client.infer(paths[2])
+    assert os.path.exists(first[0])
+    assert not os.path.exists(os.path.dirname(second[0]))
@@ -1,18 +1,401 @@
 # 字幕提取
 import torch
 # pip install faster-whisper
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 
 import os
+import io
+import json
+import hashlib
 from tqdm import tqdm
 import time
+import gc
+import platform
+import threading
+import numpy as np
 import pandas as pd
+from collections import OrderedDict, deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 # pip install pysubs2
 import pysubs2
-from srt2ass import srt2ass
+from srt2ass import srt2ass, AssWriter, escape_path
+from utils import content_hash, store_key
+
+# faster-whisper 内部统一使用16kHz单声道
+SAMPLE_RATE = 16000
+
+
+def iter_chunks(blocks, chunk_duration=300, search_duration=30, frame_ms=30, sample_rate=SAMPLE_RATE):
+    """
+    在静音处将长音频切分成若干块，逐块返回(起始采样点, 音频块)
+    blocks：音频数据块的可迭代对象（float32 numpy数组），完整音频可直接传入[audio]
+    chunk_duration：目标分块时长（秒）
+    search_duration：在目标切分点前后多少秒内寻找能量最低（最安静）的位置作为切分点
+    frame_ms：计算能量时的帧长（毫秒）
+    """
+    if chunk_duration <= 0 or search_duration < 0:
+        raise ValueError("chunk_duration 必须大于0，search_duration 不能小于0")
+    chunk = int(chunk_duration * sample_rate)
+    search = int(search_duration * sample_rate)
+    frame = max(min(int(frame_ms * sample_rate / 1000), chunk), 1)
+    # chunk_duration 小于 search_duration 时搜索范围从缓冲区开头算起
+    low = max(chunk - search, 0)
+    buffer = None
+    offset = 0
+    for block in blocks:
+        if buffer is None or len(buffer) == 0:
+            buffer = block
+        else:
+            buffer = np.concatenate([buffer, block])
+        while len(buffer) > chunk + search:
+            # 在[chunk-search, chunk+search]范围内寻找最安静的一帧
+            window = buffer[low:chunk + search]
+            n = len(window) // frame
+            energy = np.square(window[:n * frame].reshape(n, frame)).mean(axis=1)
+            cut = max(low + int(np.argmin(energy)) * frame + frame // 2, 1)
+            yield offset, buffer[:cut]
+            offset += cut
+            buffer = buffer[cut:]
+    if buffer is not None and len(buffer) > 0:
+        yield offset, buffer
+
+
+def is_block_iterator(audio):
+    """
+    是否为音频块的可迭代对象（例如utils.stream_audio返回的生成器）。
+    路径、bytes等二进制数据、文件对象和numpy数组都不算
+    """
+    if isinstance(audio, (str, bytes, bytearray, memoryview, np.ndarray)) or hasattr(audio, "read"):
+        return False
+    return isinstance(audio, Iterable)
+
+
+def clip_timestamps(audio, vad_parameters=None, max_duration=30, sample_rate=SAMPLE_RATE):
+    """
+    将一个音频切成不超过max_duration秒的片段，返回[(起始采样点, 结束采样点)]
+    vad_parameters为None时在静音处切分整段音频；否则只保留VAD检测到的语音，并把相邻语音合并成片段
+    """
+    if vad_parameters is None:
+        return [(offset, offset + len(chunk))
+                for offset, chunk in iter_chunks([audio], chunk_duration=max_duration - 2, search_duration=2,
+                                                 sample_rate=sample_rate)]
+
+    max_samples = int(max_duration * sample_rate)
+    clips = []
+    for speech in get_speech_timestamps(audio, VadOptions(**vad_parameters), sampling_rate=sample_rate):
+        start, end = speech["start"], speech["end"]
+        if clips and end - clips[-1][0] <= max_samples:
+            clips[-1] = (clips[-1][0], end)
+            continue
+        # 超长的语音段按max_duration切开
+        while end - start > max_samples:
+            clips.append((start, start + max_samples))
+            start += max_samples
+        clips.append((start, end))
+    return clips
+
+
+# 各预设模型float16权重的大致内存占用（MB），用于估算模型池的内存
+MODEL_SIZE_MB = {
+    "tiny": 75, "tiny.en": 75,
+    "base": 145, "base.en": 145,
+    "small": 484, "small.en": 484,
+    "medium": 1530, "medium.en": 1530,
+    "large-v1": 3090, "large-v2": 3090, "large-v3": 3090, "large": 3090,
+    "distil-large-v2": 1510, "distil-large-v3": 1510,
+    "large-v3-turbo": 1620, "turbo": 1620,
+}
+# 不同计算类型相对float16的内存倍数
+COMPUTE_TYPE_SCALE = {"float32": 2.0, "float16": 1.0, "bfloat16": 1.0, "int8_float16": 0.5,
+                      "int8_bfloat16": 0.5, "int8_float32": 0.5, "int8": 0.5}
+
+
+def estimate_model_size(model_name, compute_type):
+    """
+    估算模型加载后的内存占用（MB）：本地模型按model.bin的大小计算，预设模型查表
+    """
+    model_bin = os.path.join(model_name, "model.bin")
+    if os.path.isfile(model_bin):
+        # 转换好的faster-whisper模型一般以float16保存
+        size = os.path.getsize(model_bin) / (1 << 20)
+    else:
+        size = MODEL_SIZE_MB.get(os.path.basename(model_name.rstrip("/\\")).replace("faster-whisper-", ""), 1530)
+    return size * COMPUTE_TYPE_SCALE.get(compute_type, 1.0)
+
+
+class ModelPool:
+    """
+    进程内共享的WhisperModel池。
+    以(模型路径, 设备, 计算类型, cpu_threads, num_workers)为key保存已加载的模型，总内存不超过max_memory_mb，
+    超出时按最近最少使用（LRU）的顺序释放。切换回池中已有的模型时不需要重新从磁盘加载权重。
+    被释放的模型如果仍被某个Transcribe持有，会在持有者释放后才真正回收
+    """
+    def __init__(self, max_memory_mb=8192) -> None:
+        self.max_memory_mb = max_memory_mb
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, model_name, device, compute_type, cpu_threads=0, num_workers=1):
+        key = (model_name, device, compute_type, cpu_threads, num_workers)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                print(f"使用模型池中已加载的模型：{model_name}")
+                return self.models[key][0]
+
+            model = WhisperModel(model_name,device=device,compute_type=compute_type,
+                                 cpu_threads=cpu_threads,num_workers=num_workers)
+            self.models[key] = (model, estimate_model_size(model_name, compute_type))
+            self._evict()
+            return model
+
+    def _evict(self):
+        # 至少保留最近使用的一个模型
+        released = []
+        while len(self.models) > 1 and self.memory_usage() > self.max_memory_mb:
+            key, (model, size) = self.models.popitem(last=False)
+            print(f"模型池超出内存预算，释放模型：{key[0]}（约{size:.0f}MB）")
+            released.append(key[1])
+            del model
+        if released:
+            gc.collect()
+            if "cuda" in released:
+                torch.cuda.empty_cache()
+
+    def memory_usage(self):
+        return sum(size for _, size in self.models.values())
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            gc.collect()
+            torch.cuda.empty_cache()
+
+
+# 进程内全局共享的模型池，可通过 model_pool.max_memory_mb 调整内存预算
+model_pool = ModelPool()
+
+
+def segment_to_dict(segment, offset=0.0):
+    """
+    将faster-whisper的Segment转换成dict（含逐词时间戳），时间整体加上offset秒
+    """
+    return {'start':segment.start + offset,
+            'end':segment.end + offset,
+            'text':segment.text,
+            'words':[{'start':w.start + offset,'end':w.end + offset,'word':w.word,'probability':w.probability}
+                     for w in (segment.words or [])]}
+
+
+class SegmentCache:
+    """
+    转录结果的磁盘缓存。
+    以音频内容的哈希加上模型和解码参数作为key，每个key对应一个jsonl文件，每行一个分段（含逐词时间戳）。
+    命中时直接读取分段，不再调用WhisperModel.transcribe
+    """
+    def __init__(self, cache_dir="./cache/transcribe") -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, audio, **params):
+        # AudioStore 的映射数组直接用源文件的内容哈希，不再对整段解码数据重新计算哈希
+        sha = hashlib.sha256((store_key(audio) or content_hash(audio)).encode())
+        sha.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".jsonl")
+
+    def load(self, key):
+        """
+        命中时返回逐个读取分段的生成器，未命中返回None
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        def read():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        return read()
+
+    def save(self, key, segments):
+        """
+        包装分段生成器：分段在返回的同时写入缓存，全部读完后缓存才生效，中途中断则丢弃
+        """
+        path = self._path(key)
+        part_path = path + ".part"
+        completed = False
+        try:
+            with open(part_path, "w", encoding="utf-8") as f:
+                for segment in segments:
+                    f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+                    yield segment
+            os.replace(part_path, path)
+            completed = True
+        finally:
+            if not completed and os.path.exists(part_path):
+                os.remove(part_path)
+
+
+class SubtitleWriter:
+    """
+    增量写入srt和ass文件：每写入一个分段就追加到文件末尾并flush，下游可以边转录边读取
+    srt的内容与run用pysubs2保存的一致（同样去掉{...}标签），ass由AssWriter按srt2ass相同的规则转换
+    """
+    def __init__(self, audio_name, sub_style="default", is_split=False, split_method="Modest") -> None:
+        self.srt_filename = os.path.join("./temp", audio_name + ".srt")
+        self.ass_filename = escape_path(os.path.join("./temp", audio_name + ".ass"))
+        self.srt = open(self.srt_filename, "w", encoding="utf-8")
+        self.ass = AssWriter(os.path.join("./temp", audio_name + ".ass"), sub_style, is_split, split_method)
+        self.index = 0
+
+    def write(self, segment):
+        # 与run相同，先按pysubs2.load_from_whisper转换成事件，再按pysubs2保存srt的规则生成文本（去掉{...}标签等）
+        event = pysubs2.SSAEvent(start=pysubs2.make_time(s=segment['start']), end=pysubs2.make_time(s=segment['end']))
+        event.plaintext = segment['text'].strip()
+        subs = pysubs2.SSAFile()
+        subs.append(event)
+        block = subs.to_string("srt")
+        if not block:
+            # 绘图等不可见的行，pysubs2保存srt时同样跳过
+            return 0
+        self.index += 1
+        lines = block.split("\n")
+        self.srt.write("\n".join([str(self.index)] + lines[1:]))
+        self.srt.flush()
+
+        self.ass.write_line(str(self.index))
+        for line in lines[1:]:
+            self.ass.write_line(line)
+        self.ass.flush()
+        # 这一段在 ass 中对应的 Dialogue 行数（is_split 时一段会拆成多行）
+        return self.ass.dialogue_count()
+
+    def close(self):
+        self.srt.close()
+        self.ass.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# CPU自动调优结果的保存位置
+AUTOTUNE_FILE = "./cache/autotune.json"
+
+
+def host_id():
+    """
+    标识当前机器，自动调优的结果按机器分别保存
+    """
+    return f"{platform.node()}|{platform.machine()}|{platform.processor()}|{os.cpu_count()}"
+
+
+def read_autotune(autotune_file=AUTOTUNE_FILE):
+    """
+    读取全部调优结果；文件不存在或已损坏时返回空dict，损坏的文件会在下次autotune时被重写
+    """
+    if not os.path.exists(autotune_file):
+        return {}
+    try:
+        with open(autotune_file, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[autotune] 调优结果 {autotune_file} 无法读取，需要重新调优：{e}")
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def load_autotune(model_name, autotune_file=AUTOTUNE_FILE):
+    """
+    读取当前机器上model_name的调优结果，没有则返回None
+    """
+    tuned = read_autotune(autotune_file).get(host_id(), {})
+    return tuned.get(model_name) if isinstance(tuned, dict) else None
+
+
+def autotune(model_name, calibration_audio, calibration_duration=30,
+             compute_types=("int8", "int8_float32", "float32"),
+             autotune_file=AUTOTUNE_FILE, **transcribe_params):
+    """
+    CPU推理自动调优：在一段校准音频上测试不同计算类型和线程/worker分配的吞吐量，
+    把最快的配置按机器和模型保存到autotune_file，之后在CPU上创建Transcribe时会自动使用
+    calibration_audio：校准音频（文件路径、二进制流或16kHz的numpy数组），只使用前calibration_duration秒
+    compute_types：参与测试的计算类型
+    transcribe_params：传给WhisperModel.transcribe的参数，默认与run一致
+    """
+    if not isinstance(calibration_audio, np.ndarray):
+        calibration_audio = decode_audio(calibration_audio, sampling_rate=SAMPLE_RATE)
+    clip = calibration_audio[:int(calibration_duration * SAMPLE_RATE)]
+    clip_duration = len(clip) / SAMPLE_RATE
+    params = dict(beam_size=5, word_timestamps=True)
+    params.update(transcribe_params)
+
+    cores = os.cpu_count() or 1
+    splits = []
+    num_workers = 1
+    while num_workers <= cores:
+        splits.append((cores // num_workers, num_workers))
+        num_workers *= 2
+
+    best = None
+    for compute_type in compute_types:
+        for cpu_threads, num_workers in splits:
+            try:
+                model = WhisperModel(model_name, device="cpu", compute_type=compute_type,
+                                     cpu_threads=cpu_threads, num_workers=num_workers)
+            except Exception as e:
+                print(f"[autotune] {compute_type} 不可用：{e}")
+                break
+
+            def decode(_):
+                segments, _ = model.transcribe(audio=clip, **params)
+                return list(segments)
+
+            # 先预热一次，再让每个worker各转录一遍校准音频，按音频秒数/耗时计算吞吐量
+            decode(0)
+            tic = time.time()
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(decode, range(num_workers)))
+            speed = clip_duration * num_workers / (time.time() - tic)
+            print(f"[autotune] compute_type={compute_type} cpu_threads={cpu_threads} "
+                  f"num_workers={num_workers}：{speed:.2f} 倍速")
+            if best is None or speed > best["speed"]:
+                best = dict(compute_type=compute_type, cpu_threads=cpu_threads,
+                            num_workers=num_workers, speed=speed)
+            del model
+            gc.collect()
+
+    if best is None:
+        raise RuntimeError("自动调优失败，没有可用的计算类型")
+
+    config = read_autotune(autotune_file)
+    if not isinstance(config.get(host_id()), dict):
+        config[host_id()] = {}
+    config[host_id()][model_name] = best
+    os.makedirs(os.path.dirname(autotune_file) or ".", exist_ok=True)
+    with open(autotune_file, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    print(f"[autotune] 最佳配置：{best}，已保存到 {autotune_file}")
+    return best
+
 
 class Transcribe:
-    def __init__(self,model_name="small",device='cuda') -> None:
+    def __init__(self,model_name="small",device='cuda',cpu_threads=0,num_workers=1,
+                 cache_dir="./cache/transcribe") -> None:
+        '''
+        cpu_threads：CPU推理时每个worker使用的线程数，0表示使用默认值
+        num_workers：模型的并发worker数，并行分块转录（is_parallel）时即为同时解码的分块数
+        cache_dir：转录结果缓存目录，None表示不使用缓存
+        在CPU上运行时，如果当前机器已对该模型做过自动调优（见autotune），
+        会使用调优得到的计算类型，以及未手动指定时的cpu_threads和num_workers
+        '''
         # 智能选择计算类型，避免float16兼容性问题
         if device == 'cuda' and torch.cuda.is_available():
             try:
@@ -26,10 +409,151 @@ class Transcribe:
                 compute_type = "float32"
         else:
             compute_type = "float32"
+            tuned = load_autotune(model_name) if device == 'cpu' else None
+            if tuned is not None:
+                compute_type = tuned["compute_type"]
+                # 两个参数分别判断，只替换没有手动指定的那一个
+                if cpu_threads == 0:
+                    cpu_threads = tuned["cpu_threads"]
+                if num_workers == 1:
+                    num_workers = tuned["num_workers"]
+                print(f"使用自动调优配置：compute_type={compute_type}, cpu_threads={cpu_threads}, num_workers={num_workers}")
             
-        self.model = WhisperModel(model_name,device=device,compute_type=compute_type)
+        self.model_name = model_name
+        self.compute_type = compute_type
+        self.num_workers = max(num_workers, 1)
+        self.cache = SegmentCache(cache_dir) if cache_dir else None
+        self.model = model_pool.get(model_name,device=device,compute_type=compute_type,
+                                    cpu_threads=cpu_threads,num_workers=self.num_workers)
         torch.cuda.empty_cache()
 
+    def _transcribe(self, audio, transcribe_params):
+        """
+        单次调用WhisperModel.transcribe，串行地逐个返回分段
+        """
+        segments, info = self.model.transcribe(audio = audio, **transcribe_params)
+
+        with tqdm(total=round(info.duration, 2), unit=" seconds") as pbar:
+            for s in segments:
+                segment_dict = segment_to_dict(s)
+                segment_duration = round(s.end - s.start, 2)  
+                pbar.update(segment_duration)
+                yield segment_dict
+
+    def _transcribe_chunk(self, offset, chunk, transcribe_params):
+        """
+        转录一个音频分块，并将时间戳加上分块的起始时间，换算为整段音频的绝对时间
+        """
+        segments, _ = self.model.transcribe(audio = chunk, **transcribe_params)
+        start_time = offset / SAMPLE_RATE
+        return [segment_to_dict(s, start_time) for s in segments]
+
+    def _transcribe_parallel(self, audio, transcribe_params, chunk_duration=300):
+        """
+        在静音处切分音频，使用num_workers个worker并发转录各分块，再按时间顺序逐块返回分段
+        audio也可以是音频块的迭代器（例如utils.stream_audio），此时边读取边切分转录
+        """
+        if isinstance(audio, np.ndarray):
+            blocks, total = [audio], round(len(audio) / SAMPLE_RATE, 2)
+        elif isinstance(audio, str) or hasattr(audio, "read"):
+            audio = decode_audio(audio, sampling_rate=SAMPLE_RATE)
+            blocks, total = [audio], round(len(audio) / SAMPLE_RATE, 2)
+        elif is_block_iterator(audio):
+            blocks, total = audio, None
+        else:
+            raise TypeError(f"不支持的音频类型：{type(audio)}")
+
+        with tqdm(total=total, unit=" seconds") as pbar:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                pending = deque()
+                for offset, chunk in iter_chunks(blocks, chunk_duration=chunk_duration):
+                    pending.append((executor.submit(self._transcribe_chunk, offset, chunk, transcribe_params), len(chunk)))
+                    # 已经完成的分块先按顺序返回，不必等到音频全部读取完毕；
+                    # 排队的分块达到2*num_workers时等待最早的分块，解码速度快于转录时不会把整段音频都读进内存
+                    while pending and (pending[0][0].done() or len(pending) >= 2 * self.num_workers):
+                        future, chunk_length = pending.popleft()
+                        yield from future.result()
+                        pbar.update(round(chunk_length / SAMPLE_RATE, 2))
+                while pending:
+                    future, chunk_length = pending.popleft()
+                    yield from future.result()
+                    pbar.update(round(chunk_length / SAMPLE_RATE, 2))
+
+    def _segments(self, file_name, audio_binary_io, language, beam_size, is_vad_filter,
+                  min_silence_duration_ms, initial_prompt, is_parallel, chunk_duration, use_cache):
+        """
+        按run的参数转录音频，逐个返回分段；启用缓存时先查缓存，未命中则边转录边写入缓存
+        """
+        # 如果没有传入音频的二进制，则认为是本地文件
+        if audio_binary_io is None:
+            if not os.path.exists(file_name):
+                raise Exception("File not found")
+            audio = file_name
+        else:
+            audio = audio_binary_io
+        # 直接传入的媒体文件二进制数据按文件对象处理
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = io.BytesIO(audio)
+        # 音频块的迭代器（例如utils.stream_audio）只能边读边转录，总是走分块转录且不使用缓存
+        is_blocks = is_block_iterator(audio)
+
+        print("transcribe param")
+        print(f"audio: {audio}")
+        print(f"language: {language}")
+        print(f"is_vad_filter: {is_vad_filter}")
+        print(f"beam_size: {beam_size}")
+        print(f"initial_prompt: {initial_prompt}")
+
+        if is_vad_filter == False:
+            vad_parameters = None
+        else:
+            vad_parameters = dict(min_silence_duration_ms=min_silence_duration_ms)
+        
+        transcribe_params = dict(beam_size=beam_size,
+                                 language=language,
+                                 vad_filter=is_vad_filter,
+                                 vad_parameters=vad_parameters,
+                                 initial_prompt = initial_prompt,
+                                 word_timestamps=True,
+                                 #condition_on_previous_text=False,
+                                 #no_speech_threshold=0.6,
+                                 )
+
+        cache_key = None
+        if use_cache and self.cache is not None and not is_blocks:
+            cache_key = self.cache.key(audio,
+                                       model_name=self.model_name,
+                                       compute_type=self.compute_type,
+                                       language=language,
+                                       beam_size=beam_size,
+                                       vad_parameters=vad_parameters,
+                                       initial_prompt=initial_prompt,
+                                       chunk_duration=chunk_duration if is_parallel else None)
+            cached = self.cache.load(cache_key)
+            if cached is not None:
+                print(f"命中转录缓存：{cache_key}")
+                return cached
+
+        if is_parallel or is_blocks:
+            print(f"并行分块转录：num_workers={self.num_workers}, chunk_duration={chunk_duration}")
+            segments = self._transcribe_parallel(audio, transcribe_params, chunk_duration=chunk_duration)
+        else:
+            segments = self._transcribe(audio, transcribe_params)
+
+        if cache_key is not None:
+            return self.cache.save(cache_key, segments)
+        return segments
+
+    def _save_subtitles(self, results, audio_name, sub_style, is_split, split_method):
+        """
+        将转录结果保存为srt文件，再转换成ass文件
+        """
+        subs = pysubs2.load_from_whisper(results)
+        srt_filename = os.path.join("./temp",audio_name + ".srt") 
+        subs.save(srt_filename)
+        ass_filename  = srt2ass(srt_filename, sub_style, is_split,split_method)
+        return srt_filename,ass_filename
+
     def run(self,file_name,audio_binary_io = None,language='ja',
             beam_size = 5,
             is_vad_filter=False,
@@ -37,7 +561,10 @@ class Transcribe:
             is_split = False,
             split_method = "Modest",
             sub_style = "default",
-            initial_prompt= None):
+            initial_prompt= None,
+            is_parallel = False,
+            chunk_duration = 300,
+            use_cache = True):
         '''
         beam_size：数值越高，在识别时探索的路径越多，这在一定范围内可以帮助提高识别准确性，但是相对的VRAM使用也会更高. 同时，Beam Size在超过5-10后有可能降低精确性，详情请见https://arxiv.org/pdf/2204.05424.pdf                                          
         is_vad_filter：使用VAD过滤。
@@ -51,61 +578,164 @@ class Transcribe:
         sub_style：字幕样式
             default
         initial_prompt: 使用提示词能够提高输出质量,详情见： https://platform.openai.com/docs/guides/speech-to-text/prompting
+        is_parallel：是否并行分块转录（适合CPU上的长音频）
+            在静音处将音频切分成chunk_duration秒左右的分块，由num_workers个worker同时转录，再按绝对时间戳拼接
+        chunk_duration：并行分块转录时每块的目标时长（秒）
+            audio_binary_io也可以是音频块的迭代器（如utils.stream_audio(视频路径)），此时自动使用分块转录，
+            ffmpeg还在解码时就开始转录，不需要先把音频提取成临时文件
+        use_cache：是否使用转录结果缓存。
+            音频内容和解码参数都相同时直接使用上次的分段，只重新生成字幕（例如只修改了分割方式或字幕样式）
         '''
         audio_name = os.path.splitext(os.path.basename(file_name))[0]   
 
-        # 如果没有传入音频的二进制，则认为是本地文件
-        if audio_binary_io == None:
-            if not os.path.exists(file_name):
-                raise Exception("File not found")
-            audio = file_name
-        else:
-            audio = audio_binary_io
-
         tic = time.time()
+        results = list(self._segments(file_name, audio_binary_io, language, beam_size, is_vad_filter,
+                                      min_silence_duration_ms, initial_prompt, is_parallel, chunk_duration, use_cache))
+        toc = time.time()
+        srt_filename,ass_filename = self._save_subtitles(results, audio_name, sub_style, is_split, split_method)
+        print('生成srt：{} 识别耗时：{}'.format(srt_filename,toc-tic) )
+        print('生成ass：{}'.format(ass_filename))
+        return srt_filename,ass_filename
 
-        print("transcribe param")
-        print(f"audio: {audio}")
-        print(f"language: {language}")
-        print(f"is_vad_filter: {is_vad_filter}")
-        print(f"beam_size: {beam_size}")
-        print(f"initial_prompt: {initial_prompt}")
+    def stream(self,file_name,audio_binary_io = None,language='ja',
+               beam_size = 5,
+               is_vad_filter=False,
+               min_silence_duration_ms=500,
+               is_split = False,
+               split_method = "Modest",
+               sub_style = "default",
+               initial_prompt= None,
+               is_parallel = False,
+               chunk_duration = 300,
+               use_cache = True):
+        '''
+        流式转录：faster-whisper每解码出一个分段就立即返回该分段（dict：start、end、text），
+        同时追加写入 ./temp/文件名.srt 和 ./temp/文件名.ass 并flush，下游不必等整个文件转录结束。
+        分段不会在内存中累积，超长录音的内存占用保持平稳。
+        每个分段另带 ass_lines：该分段在 ass 中占几行（is_split 时一个分段可能拆成多行）
+        参数同run，生成的文件与run生成的一致
+        '''
+        audio_name = os.path.splitext(os.path.basename(file_name))[0]
+        segments = self._segments(file_name, audio_binary_io, language, beam_size, is_vad_filter,
+                                  min_silence_duration_ms, initial_prompt, is_parallel, chunk_duration, use_cache)
+        with SubtitleWriter(audio_name, sub_style, is_split, split_method) as writer:
+            for segment in segments:
+                ass_lines = writer.write(segment)
+                yield dict(segment, ass_lines=ass_lines)
+        print('生成srt：{}'.format(writer.srt_filename))
+        print('生成ass：{}'.format(writer.ass_filename))
 
+    def run_batch(self,files,language='ja',
+                  beam_size = 5,
+                  is_vad_filter=False,
+                  min_silence_duration_ms=500,
+                  is_split = False,
+                  split_method = "Modest",
+                  sub_style = "default",
+                  initial_prompt= None,
+                  batch_size = 8):
+        '''
+        批量转录多个文件，所有文件共用已加载的模型，每转录完一个文件就返回一个 (file_name, srt_filename, ass_filename)
+        files：文件路径列表，或 (file_name, audio_binary_io) 元组列表，音频可以是文件路径、二进制流或16kHz的numpy数组
+        batch_size：每次送入编码器的30秒片段数。
+            多个文件的音频会被拼接在一起，按文件切成不超过30秒的片段后由BatchedInferencePipeline批量推理，
+            因此短音频也能凑满一个batch，不会让模型空等
+        其余参数同run
+        '''
         if is_vad_filter == False:
             vad_parameters = None
         else:
             vad_parameters = dict(min_silence_duration_ms=min_silence_duration_ms)
-        
-        segments, info = self.model.transcribe(audio = audio,
-                                        beam_size=beam_size,
-                                        language=language,
-                                        vad_filter=is_vad_filter,
-                                        vad_parameters=vad_parameters,
-                                        initial_prompt = initial_prompt,
-                                        word_timestamps=True,
-                                        #condition_on_previous_text=False,
-                                        #no_speech_threshold=0.6,
-                                        )
-
-        results= []
-        with tqdm(total=round(info.duration, 2), unit=" seconds") as pbar:
-            for s in segments:
-                segment_dict = {'start':s.start,'end':s.end,'text':s.text}
-                results.append(segment_dict)
-                segment_duration = round(s.end - s.start, 2)  
-                pbar.update(segment_duration)
-        toc = time.time()
-        subs = pysubs2.load_from_whisper(results)
-    
-        # 保存srt文件
-        srt_filename = os.path.join("./temp",audio_name + ".srt") 
-        subs.save(srt_filename)
-        print('生成srt：{} 识别耗时：{}'.format(srt_filename,toc-tic) )
-        
-        # 保存ass文件
-        ass_filename  = srt2ass(srt_filename, sub_style, is_split,split_method)
-        print('生成ass：{}'.format(ass_filename))
-        return srt_filename,ass_filename
+
+        batched_model = BatchedInferencePipeline(model=self.model)
+        transcribe_params = dict(beam_size=beam_size,
+                                 language=language,
+                                 initial_prompt = initial_prompt,
+                                 word_timestamps=True,
+                                 batch_size=batch_size)
+
+        def load(item):
+            if isinstance(item, (tuple, list)):
+                file_name, audio = item
+            else:
+                file_name, audio = item, item
+            if not isinstance(audio, np.ndarray):
+                audio = decode_audio(audio, sampling_rate=SAMPLE_RATE)
+            return file_name, audio, clip_timestamps(audio, vad_parameters)
+
+        def load_group(items):
+            # 凑够若干个batch的片段后作为一组送入模型
+            group = []
+            clip_count = 0
+            for item in items:
+                group.append(load(item))
+                clip_count += len(group[-1][2])
+                if clip_count >= batch_size * 4:
+                    yield group
+                    group = []
+                    clip_count = 0
+            if group:
+                yield group
+
+        groups = load_group(files)
+        # 后台线程预先解码下一组音频，避免模型在两组之间空闲
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_group = executor.submit(next, groups, None)
+            while True:
+                group = next_group.result()
+                if group is None:
+                    break
+                next_group = executor.submit(next, groups, None)
+                yield from self._transcribe_group(batched_model, group, transcribe_params,
+                                                  sub_style, is_split, split_method)
+
+    def _transcribe_group(self, batched_model, group, transcribe_params, sub_style, is_split, split_method):
+        """
+        将一组文件的音频首尾拼接，以每个文件的片段作为clip_timestamps一次性批量转录，
+        再按各文件在拼接音频中的位置把分段分回各个文件，并换算回文件内的时间
+        """
+        spans = []
+        clips = []
+        offset = 0
+        for file_name, audio, file_clips in group:
+            spans.append((file_name, offset / SAMPLE_RATE, (offset + len(audio)) / SAMPLE_RATE))
+            clips.extend({"start": (offset + start) / SAMPLE_RATE, "end": (offset + end) / SAMPLE_RATE}
+                         for start, end in file_clips)
+            offset += len(audio)
+
+        if not clips:
+            # 整组都没有检测到语音
+            for file_name, _, _ in spans:
+                audio_name = os.path.splitext(os.path.basename(file_name))[0]
+                yield (file_name, *self._save_subtitles([], audio_name, sub_style, is_split, split_method))
+            return
+
+        audio = np.concatenate([audio for _, audio, _ in group])
+        segments, _ = batched_model.transcribe(audio, clip_timestamps=clips, **transcribe_params)
+
+        def finish(index, results):
+            file_name = spans[index][0]
+            audio_name = os.path.splitext(os.path.basename(file_name))[0]
+            srt_filename, ass_filename = self._save_subtitles(results, audio_name, sub_style, is_split, split_method)
+            print('生成srt：{}'.format(srt_filename))
+            return file_name, srt_filename, ass_filename
+
+        index = 0
+        results = []
+        for s in segments:
+            # 分段已越过当前文件的结尾，说明当前文件已转录完毕
+            while s.start >= spans[index][2] and index < len(spans) - 1:
+                yield finish(index, results)
+                index += 1
+                results = []
+            file_start = spans[index][1]
+            segment = segment_to_dict(s, -file_start)
+            segment['end'] = min(s.end, spans[index][2]) - file_start
+            results.append(segment)
+        while index < len(spans):
+            yield finish(index, results)
+            index += 1
+            results = []
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 # 字幕翻译
 import os
+import json
+import hashlib
 from tqdm import tqdm
 from typing import Union
 # !pip install openai
@@ -8,39 +10,712 @@ import pysubs2
 from engine_translation.gpt import GPT
 from engine_translation.baidu import Baidu
 from engine_translation.tencent import Tencent
+from translation_memory import TranslationMemory, normalize
+import re
+import copy
 import time
+import random
+import threading
+import weakref
+from contextlib import nullcontext
+from collections import deque
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+
+class RateLimiter:
+    """
+    令牌桶限速：每秒补充 qps 个令牌，桶容量为 burst，每次请求前取一个令牌
+    qps 为 None 或 0 时不限速
+    """
+    def __init__(self,qps=None,burst=1) -> None:
+        self.qps = qps
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.qps:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.qps)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.qps
+            time.sleep(delay)
+
+
+# 同一个翻译引擎（同一账号）共用一个令牌桶，多个 translation 实例也不会超出 QPS
+_rate_limiters = weakref.WeakKeyDictionary()
+_engine_state_lock = threading.Lock()
+
+
+def rate_limiter(engine):
+    with _engine_state_lock:
+        if engine not in _rate_limiters:
+            _rate_limiters[engine] = RateLimiter(getattr(engine, "qps", None))
+        return _rate_limiters[engine]
+
+
+# 同一个翻译引擎同时在途的请求数不超过它的 max_concurrency，与有多少个 translation 实例、多少个线程池无关
+_concurrency_limiters = weakref.WeakKeyDictionary()
+
+
+def concurrency_limiter(engine):
+    with _engine_state_lock:
+        if engine not in _concurrency_limiters:
+            _concurrency_limiters[engine] = threading.BoundedSemaphore(max(1, getattr(engine, "max_concurrency", 1) or 1))
+        return _concurrency_limiters[engine]
+
+
+# 百度翻译错误码
+BAIDU_RATE_LIMIT_CODES = {"54003", "54005"}
+BAIDU_AUTH_CODES = {"52003", "54001", "54004", "58000", "58001", "90107"}
+BAIDU_TRANSIENT_CODES = {"52001", "52002"}
+
+
+def classify_error(e):
+    """
+    把翻译接口的异常分成四类：
+    rate_limit : 超出频率限制，退避后重试
+    auth : 密钥错误、余额不足等，重试无用
+    fatal : 请求本身有问题（4xx），重试无用
+    transient : 网络抖动、超时、服务端错误，退避后重试；无法识别的异常也按这一类处理
+    """
+    # 百度的 error_code、腾讯云的 code、openai 的 status_code
+    code = str(getattr(e, "error_code", None) or getattr(e, "code", None) or "")
+    status = getattr(e, "status_code", None)
+    if status == 429 or code in BAIDU_RATE_LIMIT_CODES or "LimitExceeded" in code:
+        return "rate_limit"
+    if status in (401, 403) or code in BAIDU_AUTH_CODES or code.startswith("AuthFailure") or code.startswith("FailedOperation.NoFreeAmount"):
+        return "auth"
+    if isinstance(e, (ConnectionError, TimeoutError, HTTPException)) or code in BAIDU_TRANSIENT_CODES:
+        return "transient"
+    if isinstance(status, int) and 400 <= status < 500:
+        return "fatal"
+    return "transient"
+
+
+def backoff_delay(retry_count, kind, base=1.0, cap=30.0):
+    """
+    指数退避加随机抖动：第 n 次重试等待 [d/2, d] 秒，d = base * 2^n，频率限制时 base 加倍
+    """
+    if kind == "rate_limit":
+        base *= 2
+    delay = min(cap, base * 2 ** retry_count)
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后断开 reset_timeout 秒，期间直接拒绝请求；
+    到时后进入半开状态，只放行一个试探请求，其余请求继续等待；试探成功则恢复，失败则再次断开
+    """
+    def __init__(self,failure_threshold=5,reset_timeout=30,probe_wait=1.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # 试探请求进行中时，其它请求隔多久再来询问
+        self.probe_wait = probe_wait
+        self.failures = 0
+        self.opened_at = None
+        # 正在发送试探请求的线程
+        self.prober = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        请求前调用，返回还需要等待的秒数，0 表示可以请求（半开状态下表示本线程获得了试探资格）
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if self.prober is not None:
+                return min(self.probe_wait, self.reset_timeout)
+            self.prober = threading.get_ident()
+            return 0
+
+    def release(self):
+        """
+        试探请求因与接口状态无关的原因（如认证错误）结束时归还试探资格，由下一个请求重新试探
+        """
+        with self.lock:
+            if self.prober == threading.get_ident():
+                self.prober = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.prober = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.prober == threading.get_ident():
+                # 试探失败，重新断开
+                self.prober = None
+                self.opened_at = time.monotonic()
+            elif self.failures >= self.failure_threshold and self.opened_at is None:
+                print("翻译接口连续失败 {} 次，暂停 {} 秒".format(self.failures, self.reset_timeout))
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """
+    记录最近若干次成功请求的耗时，用于判断当前请求是否已经慢于平时（长尾）
+    """
+    def __init__(self,window=100,min_samples=20) -> None:
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self,seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self,q):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+_circuit_breakers = weakref.WeakKeyDictionary()
+_latency_trackers = weakref.WeakKeyDictionary()
+
+
+def circuit_breaker(engine):
+    with _engine_state_lock:
+        if engine not in _circuit_breakers:
+            _circuit_breakers[engine] = CircuitBreaker()
+        return _circuit_breakers[engine]
+
+
+def latency_tracker(engine):
+    with _engine_state_lock:
+        if engine not in _latency_trackers:
+            _latency_trackers[engine] = LatencyTracker()
+        return _latency_trackers[engine]
+
+
+# 对冲请求用的线程池，所有 translation 实例共用，不随实例创建和丢弃
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+# 目标语言名到输出文件名后缀
+LANGUAGE_SUFFIXES = {
+    "中文": "zh", "繁体中文": "cht", "日语": "jp", "英语": "en", "韩语": "ko",
+    "法语": "fr", "西班牙语": "es", "德语": "de", "俄语": "ru",
+}
+
+
+# 句末标点：以这些字符结尾的片段不再与下一段合并
+SENTENCE_ENDINGS = ("。", "！", "？", "!", "?", ".", "…", "」", "』", "♪")
+# 拆分译文时优先切在这些字符之后
+BREAK_CHARS = " 　，、。！？,.!?;；:：…」』"
+CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+class SentenceMerger:
+    """
+    把相邻的字幕片段合并成整句再翻译：
+    上一段不以句末标点结尾、两段间隔不超过 max_gap 秒、合并后不超过 max_chars 字时合并
+    片段按顺序逐个加入，可以边转录边合并
+    """
+    def __init__(self,max_gap=0.8,max_chars=120) -> None:
+        self.max_gap = max_gap
+        self.max_chars = max_chars
+        self.count = 0
+        self.group = []
+        self.chars = 0
+        self.last_text = ""
+        self.last_end = 0
+
+    def add(self,text,start,end):
+        """
+        加入下一段（时间单位为秒），返回因此结束的一组片段序号，没有则返回 None
+        """
+        closed = None
+        if self.group and not (
+            self.last_text and text
+            and not self.last_text.endswith(SENTENCE_ENDINGS)
+            and start - self.last_end <= self.max_gap
+            and self.chars + len(text) <= self.max_chars
+        ):
+            closed, self.group, self.chars = self.group, [], 0
+        self.group.append(self.count)
+        self.count += 1
+        self.chars += len(text)
+        self.last_text = text
+        self.last_end = end
+        return closed
+
+    def flush(self):
+        closed, self.group, self.chars = self.group, [], 0
+        return closed or None
+
+
+def join_fragments(fragments):
+    """
+    拼接同一句的各个片段：中日韩文字之间直接相连，其它情况加一个空格
+    """
+    sentence = ""
+    for fragment in fragments:
+        if sentence and not (CJK_RE.match(sentence[-1]) and CJK_RE.match(fragment[:1])):
+            sentence += " "
+        sentence += fragment
+    return sentence
+
+
+def split_translation(text,weights):
+    """
+    按权重（各片段的时长）把一句译文切成 len(weights) 段，切点尽量落在标点或空格之后
+    """
+    if len(weights) == 1:
+        return [text]
+    total = sum(weights)
+    if total <= 0:
+        weights, total = [1] * len(weights), len(weights)
+    window = max(2, len(text) // (4 * len(weights)))
+    cuts = [0]
+    acc = 0
+    for weight in weights[:-1]:
+        acc += weight
+        target = round(len(text) * acc / total)
+        cut = target
+        for offset in range(window + 1):
+            found = [pos for pos in (target - offset, target + offset) if 0 < pos < len(text) and text[pos - 1] in BREAK_CHARS]
+            if found:
+                cut = found[0]
+                break
+        cuts.append(min(len(text), max(cut, cuts[-1])))
+    cuts.append(len(text))
+    return [text[a:b].strip() for a, b in zip(cuts, cuts[1:])]
+
+
+def redistribute(groups,translations,weights,total_lines):
+    """
+    把每组（整句）的译文按 weights 拆回组内各行，返回与原始各行一一对应的译文
+    """
+    results = [None] * total_lines
+    for group, trans in zip(groups, translations):
+        for i, piece in zip(group, split_translation(trans, [weights[i] for i in group])):
+            results[i] = piece
+    return results
+
+
+def merge_sentences(texts,starts,ends,max_gap=0.8,max_chars=120):
+    """
+    一次性合并整个文件的片段，返回各组的行号列表
+    """
+    merger = SentenceMerger(max_gap, max_chars)
+    groups = []
+    for text, start, end in zip(texts, starts, ends):
+        closed = merger.add(text.strip(), start, end)
+        if closed:
+            groups.append(closed)
+    closed = merger.flush()
+    if closed:
+        groups.append(closed)
+    return groups
+
+
+class TranslationJournal:
+    """
+    翻译进度日志（jsonl，与输出文件放在一起）：第一行记录原文件哈希和翻译设置，之后每译完一行追加一行（含给出译文的引擎）
+    中断后用相同的原文件和设置重新运行，已经翻译的行直接从日志恢复
+    """
+    def __init__(self,path,header) -> None:
+        self.path = path
+        self.header = header
+        self.file = None
+
+    def open(self,total_lines):
+        """
+        打开日志，返回 {行号: 译文}；日志不存在或原文件、设置不一致时从头开始
+        """
+        done = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                header = None
+            if header == self.header:
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 中断时最后一行可能只写了一半
+                        continue
+                    if 0 <= entry["i"] < total_lines:
+                        done[entry["i"]] = entry
+        # 重写一遍日志，去掉写了一半的行，之后追加
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+        for entry in done.values():
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        return {i: entry["trans"] for i, entry in done.items()}
+
+    def write(self,indices,translations,engines):
+        for i, trans, engine in zip(indices, translations, engines):
+            self.file.write(json.dumps({"i": i, "trans": trans, "engine": type(engine).__name__}, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 
 class translation :
-    def __init__(self,engine:Union[GPT,Baidu]) -> None:
+    def __init__(self,engine:Union[GPT,Baidu,Tencent],max_concurrency=None,memory_path="./cache/translation_memory.db",
+                 secondary=None,hedge=False) -> None:
+        """
+        max_concurrency : 本实例翻译一个文件时的工作线程数，默认使用引擎的 max_concurrency
+                          （同一引擎的在途请求总数始终受引擎的 max_concurrency 限制）
+        memory_path : 翻译记忆数据库路径，None 为不使用翻译记忆
+        secondary : 备用翻译引擎，主引擎失败或熔断时改用备用引擎
+        hedge : 主引擎请求慢于最近 95% 的请求时，同时向备用引擎发出请求，取先返回的结果
+        """
         self.engine = engine
-        self.max_retries = 3
+        self.secondary = secondary
+        self.hedge = hedge and secondary is not None
+        self.hedge_percentile = 0.95
+        self.memory = TranslationMemory(memory_path) if memory_path else None
+        self.max_retries = 5
+        self.max_concurrency = max_concurrency or getattr(engine, "max_concurrency", 1)
+
+    def workers(self):
+        """
+        翻译一个文件（一个目标语言）时的工作线程数
+        带上下文的引擎（sequential 为 True，如 GPT）必须按顺序逐批发送，否则历史记录的顺序会错乱
+        """
+        if getattr(self.engine, "sequential", False):
+            return 1
+        return max(1, self.max_concurrency)
     
-    def translate_save(self,sub_src,language="中文",keep_origin = True):
+    def run_with_retry(self,engine,method,*args,fail_fast=False,**kwargs):
         """
-        keep_origin : 是否保存原文
+        调用 engine 的 method（"run" 或 "run_batch"），按错误类型处理：
+        频率限制和临时错误按指数退避重试，超过 max_retries 次抛出最后一次的异常；
+        认证错误和请求错误不重试，直接抛出
+        引擎熔断时，fail_fast 为 True 直接抛出 CircuitOpenError（交给备用引擎），否则等待熔断恢复
         """
+        breaker = circuit_breaker(engine)
+        limiter = rate_limiter(engine)
+        semaphore = concurrency_limiter(engine)
+        latency = latency_tracker(engine)
         retry_count = 0
-        sub_trans = pysubs2.load(sub_src)
-        total_lines = len(sub_trans)
-        self.engine.reset()
-        for line in tqdm(sub_trans,total = total_lines):
-            # print(line.text)
-            # try:
-            #     line_trans = self.engine.run(line.text,target_language=language)
-            # except Exception as e:
-            #     print("翻译出错：{}，进行重试".format(e))
-            #     time.sleep(1)
-            #     self.engine.run(line.text,target_language=language)    
-            while retry_count < self.max_retries:
-                try:
-                    line_trans = self.engine.run(line.text, target_language=language)
-                    retry_count = 0
-                    break  # 翻译成功，跳出循环
-                except Exception as e:
-                    print("翻译出错：{}，进行重试".format(e))
-                    time.sleep(10)
-                    retry_count += 1
+        while True:
+            remaining = breaker.acquire()
+            if remaining:
+                if fail_fast:
+                    raise CircuitOpenError("{} 已熔断".format(type(engine).__name__))
+                time.sleep(remaining)
+                continue
+            try:
+                with semaphore:
+                    limiter.acquire()
+                    start = time.monotonic()
+                    result = getattr(engine, method)(*args, **kwargs)
+            except BaseException as e:
+                kind = classify_error(e) if isinstance(e, Exception) else "fatal"
+                if kind == "transient":
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+                retry_count += 1
+                if kind in ("auth", "fatal") or retry_count >= self.max_retries:
+                    raise
+                delay = backoff_delay(retry_count - 1, kind)
+                print("翻译出错（{}）：{}，{:.1f} 秒后重试".format(kind, e, delay))
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            latency.record(time.monotonic() - start)
+            return result
+
+    def call(self,method,*args,**kwargs):
+        """
+        调用主引擎，配置了备用引擎时失败转移或对冲请求
+        返回 (结果, 实际给出结果的引擎)
+        """
+        if self.secondary is None:
+            return self.run_with_retry(self.engine, method, *args, **kwargs), self.engine
+        if not self.hedge:
+            try:
+                return self.run_with_retry(self.engine, method, *args, fail_fast=True, **kwargs), self.engine
+            except Exception as e:
+                print("主翻译引擎出错：{}，改用备用引擎".format(e))
+                return self.run_with_retry(self.secondary, method, *args, **kwargs), self.secondary
+
+        primary = _hedge_pool.submit(self.run_with_retry, self.engine, method, *args, fail_fast=True, **kwargs)
+        done, _ = wait([primary], timeout=latency_tracker(self.engine).percentile(self.hedge_percentile))
+        if done and primary.exception() is None:
+            return primary.result(), self.engine
+        if done:
+            print("主翻译引擎出错：{}，改用备用引擎".format(primary.exception()))
+            return self.run_with_retry(self.secondary, method, *args, **kwargs), self.secondary
+        # 主引擎请求进入长尾，同时请求备用引擎，取先成功的结果
+        secondary = _hedge_pool.submit(self.run_with_retry, self.secondary, method, *args, **kwargs)
+        engines = {primary: self.engine, secondary: self.secondary}
+        pending = {primary, secondary}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), engines[future]
+        raise secondary.exception()
+
+    def remember(self,texts,translations,engines,language):
+        """
+        把译文记入翻译记忆，按实际给出译文的引擎分别记录
+        """
+        by_engine = {}
+        for text, trans, engine in zip(texts, translations, engines):
+            entry = by_engine.setdefault(id(engine), (engine, [], []))
+            entry[1].append(text)
+            entry[2].append(trans)
+        for engine, engine_texts, engine_trans in by_engine.values():
+            self.memory.put_many(engine_texts, engine_trans, engine, language)
+
+    def make_batches(self,texts,batch_size,max_chars):
+        """
+        按行数 batch_size 和总字符数 max_chars 把字幕行切成若干批，返回每批的行号列表
+        """
+        batches = []
+        batch = []
+        chars = 0
+        for i, text in enumerate(texts):
+            if batch and (len(batch) >= batch_size or chars + len(text) > max_chars):
+                batches.append(batch)
+                batch = []
+                chars = 0
+            batch.append(i)
+            chars += len(text)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def translate_lines(self,texts,language="中文",batch_size=20,use_memory=True,journal=None,executor=None):
+        """
+        翻译多行文本，返回与 texts 一一对应的译文列表
+        batch_size : 每次请求合并的行数，1 为逐行翻译
+        use_memory : 是否先查翻译记忆，并且同一文件中重复的行只请求一次
+        journal : TranslationJournal，先从中恢复已翻译的行，每译完一批追加进去
+        executor : 发送请求的线程池，多个目标语言同时翻译时共用一个；None 时临时创建
+        """
+        results = [None] * len(texts)
+        if journal is not None:
+            restored = journal.open(len(texts))
+            for i, trans in restored.items():
+                results[i] = trans
+            if restored:
+                print("从进度日志恢复 {} 行".format(len(restored)))
+        missing = [i for i in range(len(texts)) if results[i] is None]
+
+        memory = self.memory if use_memory else None
+        if memory is not None:
+            for i, trans in zip(missing, memory.get_many([texts[i] for i in missing], self.engine, language)):
+                results[i] = trans
+            # 归一化后相同的行只翻译第一次出现的那一行
+            duplicates = {}
+            for i in missing:
+                if results[i] is None:
+                    duplicates.setdefault(normalize(texts[i]), []).append(i)
+            todo = [indices[0] for indices in duplicates.values()]
+            print("翻译记忆命中 {} 行，需要翻译 {} 行".format(len(missing) - sum(map(len, duplicates.values())), len(todo)))
+        else:
+            todo = missing
+
+        if batch_size > 1 and hasattr(self.engine, "run_batch"):
+            max_chars = getattr(self.engine, "batch_max_chars", 2000)
+            batches = [[todo[n] for n in batch] for batch in self.make_batches([texts[i] for i in todo], batch_size, max_chars)]
+        else:
+            batches = [[i] for i in todo]
+
+        # 各批并发请求，按行号写回结果，顺序与输入一致；每批完成后立即记入翻译记忆和进度日志
+        pool = nullcontext(executor) if executor is not None else ThreadPoolExecutor(max_workers=self.workers())
+        with tqdm(total = len(todo)) as pbar, pool as executor:
+            futures = {executor.submit(self.translate_batch, texts, batch, language): batch for batch in batches}
+            try:
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    line_trans, engines = future.result()
+                    for i, trans in zip(batch, line_trans):
+                        results[i] = trans
+                    if memory is not None:
+                        self.remember([texts[i] for i in batch], line_trans, engines, language)
+                    if journal is not None:
+                        journal.write(batch, line_trans, engines)
+                    pbar.update(len(batch))
+            except BaseException:
+                # 包括 Ctrl+C：取消还没开始的批次，不必等它们都发完才退出
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                if journal is not None:
+                    journal.close()
+
+        if memory is not None:
+            for indices in duplicates.values():
+                for i in indices[1:]:
+                    results[i] = results[indices[0]]
+        return results
+
+    def translate_batch(self,texts,batch,language):
+        """
+        翻译 batch 中的各行，返回与 batch 对应的 (译文列表, 给出各行译文的引擎列表)
+        """
+        if len(batch) > 1:
+            try:
+                line_trans, engine = self.call("run_batch", [texts[i] for i in batch], target_language=language)
+                line_trans = list(line_trans)
+            except Exception as e:
+                print("批量翻译出错：{}，改为逐行翻译".format(e))
+                line_trans, engine = [None] * len(batch), None
+            engines = [engine] * len(batch)
+            misaligned = [n for n, trans in enumerate(line_trans) if trans is None]
+            if misaligned:
+                print("批量翻译有 {} 行未对齐，逐行重译".format(len(misaligned)))
+        else:
+            line_trans, engines = [None], [None]
+            misaligned = [0]
+        # 批量结果对不上的行（或逐行模式）单独请求
+        for n in misaligned:
+            line_trans[n], engines[n] = self.call("run", texts[batch[n]], target_language=language)
+        return line_trans, engines
+
+    def translate_texts(self,texts,language="中文",use_memory=True):
+        """
+        翻译一批文本（先查翻译记忆，未命中的合并请求），返回与 texts 对应的译文列表
+        """
+        memory = self.memory if use_memory else None
+        results = memory.get_many(texts, self.engine, language) if memory is not None else [None] * len(texts)
+        todo = [n for n, trans in enumerate(results) if trans is None]
+        if todo:
+            line_trans, engines = self.translate_batch(texts, todo, language)
+            for n, trans in zip(todo, line_trans):
+                results[n] = trans
+            if memory is not None:
+                self.remember([texts[n] for n in todo], line_trans, engines, language)
+        return results
+
+    def translate_stream(self,segments,language="中文",batch_size=20,use_memory=True,max_pending=None,merge=False):
+        """
+        边转录边翻译：segments 为 Transcribe.stream 返回的分段生成器，
+        每凑满一批就交给线程池翻译，转录在当前线程继续进行
+        在途的批数超过 max_pending（默认 2 倍并发数）时等待最早的一批完成，翻译跟不上时转录随之放慢
+        merge : 是否先把相邻的句子片段合并成整句再翻译，译文按各分段的说话时长（有逐词时间戳时按词计算）拆回
+        返回与分段一一对应的译文列表
+        """
+        merger = SentenceMerger() if merge else None
+        texts = []
+        weights = []
+        groups = []
+
+        def units():
+            # 把分段转换成待翻译的单元（不合并时一个分段就是一个单元）
+            for segment in segments:
+                text = segment["text"].strip()
+                texts.append(text)
+                words = segment.get("words") or []
+                weights.append(sum(word["end"] - word["start"] for word in words) or segment["end"] - segment["start"])
+                if merger is None:
+                    groups.append([len(texts) - 1])
+                    yield text
+                    continue
+                closed = merger.add(text, segment["start"], segment["end"])
+                if closed:
+                    groups.append(closed)
+                    yield join_fragments([texts[i] for i in closed])
+            closed = merger.flush() if merger is not None else None
+            if closed:
+                groups.append(closed)
+                yield join_fragments([texts[i] for i in closed])
+
+        max_chars = getattr(self.engine, "batch_max_chars", 2000)
+        max_pending = max_pending or 2 * self.workers()
+        results = []
+        # 在途的 (future, 这一批在结果中的起始位置)
+        pending = deque()
+        batch = []
+        chars = 0
+        with ThreadPoolExecutor(max_workers=self.workers()) as executor:
+            def collect():
+                future, start = pending.popleft()
+                line_trans = future.result()
+                results[start:start + len(line_trans)] = line_trans
+
+            def submit(batch):
+                pending.append((executor.submit(self.translate_texts, batch, language, use_memory), len(results) - len(batch)))
+                while len(pending) > max_pending:
+                    collect()
+
+            try:
+                for text in units():
+                    if batch and (len(batch) >= batch_size or chars + len(text) > max_chars):
+                        submit(batch)
+                        batch, chars = [], 0
+                    batch.append(text)
+                    chars += len(text)
+                    results.append(None)
+                if batch:
+                    submit(batch)
+                while pending:
+                    collect()
+            except BaseException:
+                for future, _ in pending:
+                    future.cancel()
+                raise
+        return redistribute(groups, results, weights, len(texts))
 
+    def output_paths(self,sub_src,language):
+        language_code = LANGUAGE_SUFFIXES.get(language)
+        if language_code is None:
+            # 直接给出语言代码（如 "fr"、"zh-TW"）时用代码作后缀，其它写法用语言名本身作后缀，各语言互不相同；
+            # 语言名中有文件名不能用的字符时替换掉，并加上语言名的哈希以免替换后重名
+            language_code = language
+            if not re.fullmatch(r"[A-Za-z]{2,3}(-[A-Za-z]{2,4})?", language):
+                language_code = re.sub(r'[\\/:*?"<>|\s]+', "-", language).strip("-.")
+                if language_code != language:
+                    language_code += "-" + hashlib.sha1(language.encode("utf-8")).hexdigest()[:6]
+        save_ass_path = "./temp/" + os.path.splitext(os.path.basename(sub_src))[0]+ "_"+ language_code +".ass"
+        save_srt_path = "./temp/" + os.path.splitext(os.path.basename(sub_src))[0]+ "_" + language_code +".srt"
+        return save_ass_path,save_srt_path
+
+    def save_translation(self,sub_src,translated,language,keep_origin = True,subs=None):
+        """
+        把译文写回 sub_src 的每一行，另存为 ./temp/文件名_语言.ass 和 .srt
+        subs : 已经解析好的 sub_src，传入时复制一份使用，不再重新读取
+        """
+        save_ass_path, save_srt_path = self.output_paths(sub_src, language)
+        # print(save_ass_path)
+        # print(save_srt_path)
+        sub_trans = copy.deepcopy(subs) if subs is not None else pysubs2.load(sub_src)
+        for line, line_trans in zip(sub_trans, translated):
             if keep_origin:
                 line.text += (r'\N'+ line_trans)
             else:
@@ -48,21 +723,121 @@ class translation :
             print(line.text)
  
 
-        if language == "中文":
-            language = 'zh'
-        elif language == "日语":
-            language = 'jp'
-        elif language == "英语":
-            language = 'en'
-        else:
-            language = "other"
-        save_ass_path = "./temp/" + os.path.splitext(os.path.basename(sub_src))[0]+ "_"+ language +".ass"
-        save_srt_path = "./temp/" + os.path.splitext(os.path.basename(sub_src))[0]+ "_" + language +".srt"
-        # print(save_ass_path)
-        # print(save_srt_path)
         sub_trans.save(save_ass_path)
         sub_trans.save(save_srt_path)
         return save_ass_path,save_srt_path
+
+    def translate_save(self,sub_src,language="中文",keep_origin = True,batch_size=20,use_memory=True,resume=True,merge=False):
+        """
+        keep_origin : 是否保存原文
+        batch_size : 每次请求合并翻译的行数，1 为逐行翻译
+        use_memory : 是否使用翻译记忆
+        resume : 是否记录进度日志，中断后重新运行时从未翻译的行继续
+        merge : 是否把相邻的句子片段合并成整句翻译，译文再按各行时长拆回
+        """
+        sub_trans = pysubs2.load(sub_src)
+        self.engine.reset()
+        return self.translate_parsed(sub_src, sub_trans, language, keep_origin, batch_size, use_memory, resume, merge)
+
+    def translate_save_multi(self,sub_src,languages=("中文","英语"),keep_origin = True,batch_size=20,use_memory=True,resume=True,merge=False):
+        """
+        一次解析 sub_src，同时翻译成多个目标语言，各语言共用同一个引擎（连接、限速、熔断），
+        在途请求总数不随语言数增加
+        普通引擎的各语言共用同一个请求线程池；带上下文的引擎（sequential 为 True，如 GPT）每个语言一条按顺序发送的通道，
+        各语言的上下文互相独立，最多 max_concurrency 个语言同时翻译
+        返回 {语言: (ass 路径, srt 路径)}，其余参数同 translate_save
+        """
+        sub_trans = pysubs2.load(sub_src)
+        languages = list(dict.fromkeys(languages))
+
+        def translate(language, executor):
+            return self.translate_parsed(sub_src, sub_trans, language, keep_origin, batch_size, use_memory, resume, merge, executor)
+
+        if getattr(self.engine, "sequential", False):
+            def lane(language):
+                # 只清空这个语言的上下文，其它语言的通道还在翻译；单线程的线程池保证同一语言的请求按顺序发送
+                self.engine.reset(language)
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    return translate(language, executor)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(len(languages), self.max_concurrency))) as fanout:
+                futures = {language: fanout.submit(lane, language) for language in languages}
+                return {language: future.result() for language, future in futures.items()}
+
+        self.engine.reset()
+        with ThreadPoolExecutor(max_workers=self.workers()) as executor:
+            # 各语言的线程只负责拆批和写文件，请求都提交到 executor
+            with ThreadPoolExecutor(max_workers=max(1, len(languages))) as fanout:
+                futures = {language: fanout.submit(translate, language, executor) for language in languages}
+                return {language: future.result() for language, future in futures.items()}
+
+    def translate_parsed(self,sub_src,sub_trans,language,keep_origin = True,batch_size=20,use_memory=True,resume=True,merge=False,executor=None):
+        """
+        翻译已经解析好的字幕 sub_trans（不修改它），保存到 sub_src 对应的输出路径
+        executor : 发送请求的线程池，见 translate_lines
+        """
+        journal = None
+        if resume:
+            with open(sub_src, "rb") as f:
+                source_hash = hashlib.sha256(f.read()).hexdigest()
+            journal = TranslationJournal(os.path.splitext(self.output_paths(sub_src, language)[0])[0] + ".journal.jsonl", {
+                "source": source_hash,
+                "engine": type(self.engine).__name__,
+                "model": getattr(self.engine, "model", ""),
+                "secondary": type(self.secondary).__name__ if self.secondary is not None else None,
+                "secondary_model": getattr(self.secondary, "model", ""),
+                "language": language,
+                "merge": merge,
+            })
+
+        texts = [line.text for line in sub_trans]
+        if merge:
+            # 合并成整句翻译，再按各行时长把译文拆回
+            groups = merge_sentences(texts, [line.start / 1000 for line in sub_trans], [line.end / 1000 for line in sub_trans])
+            units = [join_fragments([texts[i].strip() for i in group]) for group in groups]
+            print("{} 行合并为 {} 句翻译".format(len(texts), len(units)))
+            unit_trans = self.translate_lines(units, language, batch_size, use_memory, journal, executor)
+            translated = redistribute(groups, unit_trans, [line.end - line.start for line in sub_trans], len(texts))
+        else:
+            translated = self.translate_lines(texts, language, batch_size, use_memory, journal, executor)
+        save_ass_path, save_srt_path = self.save_translation(sub_src, translated, language, keep_origin, sub_trans)
+        # 全部保存成功后不再需要进度日志
+        if journal is not None:
+            journal.remove()
+        return save_ass_path,save_srt_path
+
+    def transcribe_translate_save(self,segments,sub_src,language="中文",keep_origin = True,batch_size=20,use_memory=True,merge=False):
+        """
+        转录和翻译重叠进行：segments 为 Transcribe.stream 返回的分段生成器，sub_src 为它写出的 ass 文件
+        转录结束时大部分行已经翻译完，最后生成单语字幕（由 stream 写出）和双语字幕
+        merge : 是否把相邻的句子片段合并成整句翻译，译文按逐词时间戳计算的说话时长拆回各分段
+        返回翻译后的 ass 和 srt 路径
+        """
+        self.engine.reset()
+        # 各分段在 ass 中占的行数，is_split 拆分过的分段占多行
+        line_counts = []
+
+        def counted():
+            for segment in segments:
+                line_counts.append(segment.get("ass_lines", 1))
+                yield segment
+
+        translated = self.translate_stream(counted(), language, batch_size, use_memory, merge=merge)
+        subs = pysubs2.load(sub_src)
+        if len(subs) != len(translated) and len(subs) == sum(line_counts):
+            # 分段被拆成了多行：每个分段的译文按各行的字数拆回这几行
+            groups = []
+            pos = 0
+            for count in line_counts:
+                groups.append(list(range(pos, pos + count)))
+                pos += count
+            translated = redistribute([group for group in groups if group], [trans for trans, group in zip(translated, groups) if group],
+                                      [len(line.text.replace("(adjust_required)", "")) for line in subs], len(subs))
+        if len(subs) != len(translated):
+            # 字幕行和分段对不上（例如文本中含有类似时间轴的行），退回按字幕行翻译
+            print("字幕行与转录分段数量不一致，按字幕文件重新翻译")
+            return self.translate_save(sub_src, language, keep_origin, batch_size, use_memory, merge=merge)
+        return self.save_translation(sub_src, translated, language, keep_origin, subs)
   
         
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+# 翻译记忆：把已经翻译过的字幕行保存在 SQLite 中，重复出现的行直接复用译文
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import pysubs2
+
+
+def normalize(text):
+    """
+    归一化原文作为查询 key：NFKC（全角/半角统一）、去掉首尾空白、连续空白合并为一个空格
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+# 界面上的语言名到语言代码：翻译记忆按语言代码保存，界面文字改名不影响已有的记录
+LANGUAGE_KEYS = {
+    "中文": "zh", "繁体中文": "zh-tw", "日语": "ja", "英语": "en", "韩语": "ko",
+    "法语": "fr", "西班牙语": "es", "德语": "de", "俄语": "ru",
+}
+
+
+def language_key(language):
+    """
+    归一化语言作为查询 key：界面语言名换成语言代码，其它写法（"ja"、"zh-TW"、"auto"）去空白转小写
+    """
+    language = language.strip()
+    return LANGUAGE_KEYS.get(language, language.lower())
+
+
+def engine_key(engine, model=None):
+    """
+    返回 (引擎名, 模型名)，engine 可以是引擎实例，也可以是 "GPT"、"Baidu" 这样的名字
+    """
+    if isinstance(engine, str):
+        return engine, model or ""
+    return type(engine).__name__, model or getattr(engine, "model", "") or ""
+
+
+class TranslationMemory:
+    """
+    以 (引擎, 模型, 源语言, 目标语言, 归一化原文) 为 key 保存译文
+    同一个数据库可以被多个线程共用
+    """
+    def __init__(self, db_path="./cache/translation_memory.db") -> None:
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "engine TEXT, model TEXT, source_language TEXT, target_language TEXT, "
+            "source_text TEXT, target_text TEXT, hits INTEGER DEFAULT 0, "
+            "PRIMARY KEY (engine, model, source_language, target_language, source_text))"
+        )
+        # 旧版本按界面语言名保存的记录改用语言代码
+        for name, code in LANGUAGE_KEYS.items():
+            for column in ("source_language", "target_language"):
+                self.conn.execute("UPDATE OR REPLACE memory SET {0}=? WHERE {0}=?".format(column), (code, name))
+        self.conn.commit()
+
+    def get_many(self, texts, engine, target_language, source_language="auto", model=None):
+        """
+        查询多行原文，返回与 texts 一一对应的译文列表，未命中的为 None
+        """
+        name, model = engine_key(engine, model)
+        source_language, target_language = language_key(source_language), language_key(target_language)
+        keys = [normalize(text) for text in texts]
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            # 分批查询，避免超过 SQLite 的参数个数限制
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT source_text, target_text FROM memory WHERE engine=? AND model=? "
+                    "AND source_language=? AND target_language=? AND source_text IN ({})".format(",".join("?" * len(chunk))),
+                    [name, model, source_language, target_language] + chunk,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                self.conn.executemany(
+                    "UPDATE memory SET hits=hits+1 WHERE engine=? AND model=? AND source_language=? "
+                    "AND target_language=? AND source_text=?",
+                    [(name, model, source_language, target_language, key) for key in found],
+                )
+                self.conn.commit()
+        return [found.get(key) for key in keys]
+
+    def put_many(self, texts, translations, engine, target_language, source_language="auto", model=None):
+        """
+        保存多行译文，空原文或空译文不保存
+        """
+        name, model = engine_key(engine, model)
+        source_language, target_language = language_key(source_language), language_key(target_language)
+        rows = [
+            (name, model, source_language, target_language, normalize(text), trans)
+            for text, trans in zip(texts, translations)
+            if normalize(text) and trans and trans.strip()
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memory (engine, model, source_language, target_language, source_text, target_text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+        return len(rows)
+
+    def import_ass(self, sub_path, engine, target_language, source_language="auto", model=None):
+        """
+        从 keep_origin=True 生成的双语字幕导入：译文接在原文后面，每行在最后一个 \\N 处分成原文和译文
+        （原文本身可能是多行，含有 \\N）
+        返回导入的行数
+        """
+        texts = []
+        translations = []
+        for line in pysubs2.load(sub_path):
+            if r"\N" not in line.text:
+                continue
+            text, trans = line.text.rsplit(r"\N", 1)
+            texts.append(text)
+            translations.append(trans)
+        return self.put_many(texts, translations, engine, target_language, source_language, model)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == '__main__':
+    # python translation_memory.py <引擎名> <模型名> <目标语言> 双语字幕1.ass 双语字幕2.ass ...
+    import sys
+    memory = TranslationMemory()
+    engine, model, target_language = sys.argv[1:4]
+    for path in sys.argv[4:]:
+        print("{}：导入 {} 行".format(path, memory.import_ass(path, engine, target_language, model=model)))
@@ -2,6 +2,18 @@
 import ffmpeg
 import os
 import json
+import re
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import pysubs2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# 软字幕封装时按输出格式选择字幕编码：mkv保留ASS样式，mp4系列只支持mov_text
+SOFT_SUBTITLE_CODECS = {".mkv": "ass", ".mp4": "mov_text", ".m4v": "mov_text", ".mov": "mov_text"}
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
 
 def extract_audio(video_path, output_audio_path):
     """
@@ -24,20 +36,299 @@ def extract_audio(video_path, output_audio_path):
     except ffmpeg.Error as e:
         raise e
 
-def merge_subtitles_to_video(video_path, subtitle_path, output_video_path):
+def _decode_process(media_path, sample_rate, channels=1):
+    """
+    启动ffmpeg进程，把音频解码成float32 PCM写到stdout
+    """
+    return (
+        ffmpeg
+        .input(media_path)
+        .output('pipe:', format='f32le', acodec='pcm_f32le', ac=channels, ar=sample_rate)
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdout=True)
+    )
+
+def stream_audio(media_path, sample_rate=16000, block_duration=30):
+    """
+    用ffmpeg把媒体文件中的音频解码成单声道float32 PCM，通过管道逐块读取，不生成临时文件。
+    返回float32 numpy数组块的生成器，可以直接交给Transcribe边解码边转录。
+    参数:
+    media_path (str): 视频或音频文件的路径。
+    sample_rate (int): 输出采样率，faster-whisper使用16000。
+    block_duration (float): 每块的时长（秒）。
+    """
+    if not os.path.exists(media_path):
+        raise FileNotFoundError(f"{media_path} not found")
+    process = _decode_process(media_path, sample_rate)
+    block_size = int(sample_rate * block_duration) * 4
+    try:
+        while True:
+            data = process.stdout.read(block_size)
+            if not data:
+                break
+            yield np.frombuffer(data, dtype=np.float32)
+        if process.wait() != 0:
+            raise RuntimeError(f"Failed to decode audio: {media_path}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+def load_audio(media_path, sample_rate=16000, channels=1):
+    """
+    用ffmpeg把媒体文件中的音频一次性解码成float32 numpy数组（通过管道，不生成临时文件）。
+    参数:
+    media_path (str): 视频或音频文件的路径。
+    sample_rate (int): 输出采样率，faster-whisper使用16000。
+    channels (int): 声道数，单声道返回一维数组，多声道返回(采样点数, 声道数)。
+    """
+    if not os.path.exists(media_path):
+        raise FileNotFoundError(f"{media_path} not found")
+    try:
+        out, _ = (
+            ffmpeg
+            .input(media_path)
+            .output('pipe:', format='f32le', acodec='pcm_f32le', ac=channels, ar=sample_rate)
+            .global_args('-loglevel', 'error')
+            .run(capture_stdout=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to decode audio: {e}")
+    audio = np.frombuffer(out, dtype=np.float32)
+    if channels > 1:
+        audio = audio.reshape(-1, channels)
+    return audio
+
+def find_fonts(fonts):
+    """
+    返回要附加的字体文件列表。
+    参数:
+    fonts: 字体文件路径的列表，或者字体目录（目录不存在时返回空列表）。
+    """
+    if fonts is None:
+        return []
+    if isinstance(fonts, str):
+        if not os.path.isdir(fonts):
+            return []
+        fonts = [os.path.join(fonts, f) for f in sorted(os.listdir(fonts))]
+    return [f for f in fonts if f.lower().endswith(FONT_EXTENSIONS) and os.path.isfile(f)]
+
+def mux_subtitles(video_path, subtitle_path, output_video_path, fonts="./fonts"):
+    """
+    把字幕作为字幕轨封装进视频，视频和音频直接复制，不重新编码。
+    输出为mkv时保留ASS字幕并附加字体，为mp4/m4v/mov时字幕转换成mov_text。
+    参数:
+    video_path (str): 视频文件的路径。
+    subtitle_path (str): 字幕文件的路径。
+    output_video_path (str): 输出视频文件的路径，扩展名决定封装格式。
+    fonts: 附加到mkv中的字体，字体文件列表或字体目录。
+    """
+    ext = os.path.splitext(output_video_path)[1].lower()
+    if ext not in SOFT_SUBTITLE_CODECS:
+        raise ValueError(f"软字幕只支持输出为 {', '.join(SOFT_SUBTITLE_CODECS)}，当前为 {ext}")
+    video = ffmpeg.input(video_path)
+    kwargs = {'c:v': 'copy', 'c:a': 'copy', 'c:s': SOFT_SUBTITLE_CODECS[ext]}
+    attachments = find_fonts(fonts) if ext == ".mkv" else []
+    if attachments:
+        kwargs['metadata:s:t'] = 'mimetype=application/x-truetype-font'
+    args = (
+        ffmpeg
+        .output(video['v'], video['a?'], ffmpeg.input(subtitle_path), output_video_path, **kwargs)
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .compile()
+    )
+    # ffmpeg-python不能重复同一个输出参数，-attach 直接插在输出文件名前面
+    position = args.index(output_video_path)
+    for font in attachments:
+        args[position:position] = ['-attach', font]
+        position += 2
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to mux subtitles into video: {result.stderr.decode(errors='replace')}")
+
+def encoder_args(vcodec=None, preset=None, crf=None, threads=None):
+    """
+    视频编码参数，为None的项使用ffmpeg的默认值
+    """
+    kwargs = {}
+    if vcodec is not None:
+        kwargs['vcodec'] = vcodec
+    if preset is not None:
+        kwargs['preset'] = preset
+    if crf is not None:
+        kwargs['crf'] = crf
+    if threads is not None:
+        kwargs['threads'] = threads
+    return kwargs
+
+DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+def media_duration(media_path):
+    """
+    媒体文件的时长（秒）。优先用ffprobe读取；没有安装ffprobe时解析 ffmpeg -i 输出中的 Duration
+    """
+    try:
+        return float(ffmpeg.probe(media_path)['format']['duration'])
+    except FileNotFoundError:
+        pass
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to probe {media_path}: {e.stderr.decode(errors='replace')}")
+    if not os.path.exists(media_path):
+        raise FileNotFoundError(f"{media_path} not found")
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-i', media_path], capture_output=True)
+    match = DURATION_RE.search(result.stderr.decode(errors='replace'))
+    if match is None:
+        raise RuntimeError(f"Failed to read the duration of {media_path}")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def split_video(video_path, work_dir, segments):
+    """
+    把视频流（不含音频）不重新编码地切成大约 segments 段。
+    流复制只能在关键帧处切分，ffmpeg会在每个切分点之后的第一个关键帧处切开，实际的分段时间从分段列表读取。
+    返回 [(分段文件路径, 开始秒, 结束秒), ...]
+    """
+    duration = media_duration(video_path)
+    times = ",".join(f"{duration * i / segments:.3f}" for i in range(1, segments))
+    list_path = os.path.join(work_dir, "segments.csv")
+    # 有B帧的视频第一帧的解码时间戳为负，默认会把整个时间轴后移，分段列表中的时间随之偏移；
+    # 不做平移，分段列表中的时间与原始视频的显示时间一致，字幕才能对齐
+    kwargs = {'map': '0:v:0', 'c': 'copy', 'f': 'segment', 'segment_list': list_path,
+              'segment_list_type': 'csv', 'reset_timestamps': 1, 'avoid_negative_ts': 'disabled'}
+    if times:
+        kwargs['segment_times'] = times
+    try:
+        (
+            ffmpeg
+            .input(video_path)
+            .output(os.path.join(work_dir, "source_%04d.mkv"), **kwargs)
+            .global_args('-loglevel', 'error')
+            .run(overwrite_output=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to split video: {e.stderr.decode(errors='replace')}")
+    parts = []
+    with open(list_path, "r", encoding="utf-8") as f:
+        for line in f:
+            name, start, end = line.strip().rsplit(",", 2)
+            parts.append((os.path.join(work_dir, name), float(start), float(end)))
+    return parts
+
+def escape_filter_path(path):
+    """
+    把路径转成可以直接写进滤镜参数的形式：分隔符统一为/，再按ffmpeg的两层规则转义
+    （滤镜参数中的 \\ ' :，滤镜图中的 \\ ' [ ] , ;），Windows盘符中的冒号不会被当成参数分隔符
+    """
+    path = path.replace("\\", "/")
+    path = re.sub(r"([\\':])", r"\\\1", path)
+    return re.sub(r"([\\'\[\],;])", r"\\\1", path)
+
+def burn_segment(segment_path, subtitle_path, output_path, **encoder):
+    """
+    把字幕烧录进一个分段（不含音频）
+    """
+    subtitle_path = escape_filter_path(subtitle_path)
+    try:
+        (
+            ffmpeg
+            .input(segment_path)
+            .output(output_path, vf=f"subtitles={subtitle_path}", an=None, **encoder)
+            .global_args('-loglevel', 'error')
+            .run(overwrite_output=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to burn subtitles into {segment_path}: {e.stderr.decode(errors='replace')}")
+
+def hardsub_parallel(video_path, subtitle_path, output_video_path, segments=None, jobs=None,
+                     vcodec=None, preset=None, crf=None, threads=None):
+    """
+    分段并行烧录字幕：在关键帧处把视频切成 segments 段，每段的字幕平移到分段自己的时间轴上，
+    最多 jobs 个ffmpeg进程同时编码，编码后的分段用concat无损拼接，再直接复制原始音频封装进去。
+    参数:
+    segments (int): 分段数，默认等于CPU核数。
+    jobs (int): 同时编码的分段数，默认等于 segments。
+    vcodec/preset/crf (str/int): 视频编码器、编码预设和CRF，为None时使用ffmpeg默认值。
+    threads (int): 每个编码进程的线程数，默认把CPU核数平均分给同时运行的进程。
+    """
+    cpu_count = os.cpu_count() or 1
+    segments = segments or cpu_count
+    jobs = min(jobs or segments, segments)
+    if threads is None:
+        threads = max(cpu_count // jobs, 1)
+    encoder = encoder_args(vcodec, preset, crf, threads)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_video_path)))
+    try:
+        parts = split_video(video_path, work_dir, segments)
+        print(f"视频切分为 {len(parts)} 段，{jobs} 个进程并行烧录字幕")
+        subs = pysubs2.load(subtitle_path)
+        tasks = []
+        for i, (segment_path, start, end) in enumerate(parts):
+            # 只保留与分段重叠的字幕，并平移到分段的时间轴（分段从0开始）
+            part_subs = pysubs2.SSAFile()
+            part_subs.info = subs.info.copy()
+            part_subs.styles = subs.styles.copy()
+            part_subs.events = [line.copy() for line in subs
+                                if line.end > start * 1000 and line.start < end * 1000]
+            part_subs.shift(s=-start)
+            part_subtitle = os.path.join(work_dir, f"subtitle_{i:04d}.ass")
+            part_subs.save(part_subtitle)
+            # 优先用相对路径，滤镜参数短且不含盘符；与当前目录不在同一个盘（Windows）时没有相对路径，
+            # 直接用绝对路径，盘符中的冒号由burn_segment转义
+            try:
+                part_subtitle = os.path.relpath(part_subtitle)
+            except ValueError:
+                pass
+            tasks.append((segment_path, part_subtitle, os.path.join(work_dir, f"encoded_{i:04d}.mkv")))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(burn_segment, *task, **encoder) for task in tasks]:
+                future.result()
+        concat_path = os.path.join(work_dir, "concat.txt")
+        with open(concat_path, "w", encoding="utf-8") as f:
+            for _, _, encoded_path in tasks:
+                f.write("file '{}'\n".format(os.path.abspath(encoded_path).replace("\\", "/").replace("'", "'\\''")))
+        video = ffmpeg.input(concat_path, f='concat', safe=0)
+        try:
+            (
+                ffmpeg
+                .output(video['v'], ffmpeg.input(video_path)['a?'], output_video_path, c='copy')
+                .global_args('-loglevel', 'error')
+                .run(overwrite_output=True, capture_stderr=True)
+            )
+        except ffmpeg.Error as e:
+            raise RuntimeError(f"Failed to concat video segments: {e.stderr.decode(errors='replace')}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def merge_subtitles_to_video(video_path, subtitle_path, output_video_path, mode="hard", fonts="./fonts",
+                             segments=1, jobs=None, vcodec=None, preset=None, crf=None, threads=None):
     """
     将字幕文件合并到视频文件中。
     参数:
     video_path (str): 视频文件的路径。
     subtitle_path (str): 字幕文件的路径。
     output_video_path (str): 合并字幕后的输出视频文件的路径。
+    mode (str): "hard"把字幕烧录进画面，需要重新编码整个视频；
+        "soft"复制视频和音频流，字幕作为字幕轨封装（见mux_subtitles），几秒即可完成。
+    fonts: 软字幕输出为mkv时附加的字体，字体文件列表或字体目录。
+    segments (int): 烧录时的分段数，大于1时分段并行编码（见hardsub_parallel），为None时等于CPU核数。
+    jobs/vcodec/preset/crf/threads: 烧录时的并行进程数和编码参数，为None时使用默认值。
     """
+    if mode not in ("hard", "soft"):
+        raise ValueError(f"mode 只能是 hard 或 soft，当前为 {mode}")
     if not os.path.exists(video_path):
         raise FileNotFoundError(f"{video_path} not found")
     if not os.path.exists(subtitle_path):
         raise FileNotFoundError(f"{subtitle_path} not found")
     if os.path.exists(output_video_path):
         os.remove(output_video_path)
+    if mode == "soft":
+        mux_subtitles(video_path, subtitle_path, output_video_path, fonts)
+        return
+    if segments != 1:
+        hardsub_parallel(video_path, subtitle_path, output_video_path, segments, jobs, vcodec, preset, crf, threads)
+        return
     
     subtitle_path = subtitle_path.replace("\\", "/")
     print("subtitle_path = {}".format(subtitle_path))
@@ -45,12 +336,163 @@ def merge_subtitles_to_video(video_path, subtitle_path, output_video_path):
         (
             ffmpeg
             .input(video_path)
-            .output(output_video_path, vf=f"subtitles={subtitle_path}")
+            .output(output_video_path, vf=f"subtitles={subtitle_path}", **encoder_args(vcodec, preset, crf, threads))
             .run(overwrite_output=True)
         )
     except ffmpeg.Error as e:
         raise RuntimeError(f"Failed to merge subtitles into video: {e}")
 
+def content_hash(audio, block_size=1 << 20):
+    """
+    计算音频内容的sha256，用于缓存的key。
+    参数:
+    audio: 文件路径、二进制流（计算后会恢复读取位置）或numpy数组
+    """
+    sha = hashlib.sha256()
+    if isinstance(audio, np.ndarray):
+        sha.update(str(audio.dtype).encode())
+        sha.update(np.ascontiguousarray(audio))
+    elif hasattr(audio, "read"):
+        position = audio.tell()
+        for block in iter(lambda: audio.read(block_size), b""):
+            sha.update(block)
+        audio.seek(position)
+    else:
+        with open(audio, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+def touch(path):
+    """
+    更新修改时间，记录缓存条目最近一次被使用
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def _entry_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def prune_cache(cache_dir, max_bytes, keep=()):
+    """
+    缓存目录的总大小超过 max_bytes 时，按最近使用时间（修改时间）从旧到新删除顶层条目（文件或目录），
+    直到不超过 max_bytes。keep 中的路径和正在写入的 .part/.tmp 文件不删除；
+    删除失败（例如Windows上文件仍被映射）的条目跳过。返回删除的条目数。
+    """
+    if max_bytes is None or not os.path.isdir(cache_dir):
+        return 0
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            size, mtime = _entry_size(path), os.path.getmtime(path)
+        except OSError:
+            continue
+        total += size
+        if not name.endswith((".part", ".tmp")) and os.path.abspath(path) not in keep:
+            entries.append((mtime, size, path))
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+# AudioStore 数据文件名：<源文件内容哈希>_<采样率>_<声道数>.f32
+STORE_FILE_RE = re.compile(r"^([0-9a-f]{64})_(\d+)_(\d+)\.f32$")
+
+def store_key(audio):
+    """
+    audio 是 AudioStore.get 返回的完整映射数组时，返回"<源文件内容哈希>_<采样率>_<声道数>"，否则返回None。
+    数据文件按源文件内容哈希命名且写入后不再改变，可以代替对整段解码数据重新计算哈希
+    """
+    if not isinstance(audio, np.memmap) or not audio.filename:
+        return None
+    match = STORE_FILE_RE.match(os.path.basename(audio.filename))
+    # 切片得到的映射也带着同一个文件名，只有覆盖整个文件时才能代表整个数据
+    if match is None or audio.nbytes != os.path.getsize(audio.filename):
+        return None
+    return os.path.splitext(os.path.basename(audio.filename))[0]
+
+class AudioStore:
+    """
+    解码后音频的共享存储。
+    每个输入按(内容哈希, 采样率, 声道数)只解码一次，保存为float32原始数据文件，之后通过np.memmap只读映射，
+    ASR（16kHz单声道）、VAD和UVR（44.1kHz双声道）等环节直接读取同一份数据，不再重复解码，也不需要拷贝到内存。
+    重复处理同一个媒体文件时不再有解码开销。
+    存储总大小超过 max_bytes 时按最近使用时间淘汰旧的数据文件（None 表示不限制）。
+    """
+    def __init__(self, store_dir="./cache/audio", max_bytes=20 << 30):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        os.makedirs(store_dir, exist_ok=True)
+        # (路径, 大小, 修改时间) -> 内容哈希，避免同一个文件反复计算哈希
+        self.hashes = {}
+
+    def _hash(self, media_path):
+        stat = os.stat(media_path)
+        key = (os.path.abspath(media_path), stat.st_size, stat.st_mtime)
+        if key not in self.hashes:
+            self.hashes[key] = content_hash(media_path)
+        return self.hashes[key]
+
+    def path(self, media_path, sample_rate=16000, channels=1):
+        """
+        返回解码数据文件的路径，不存在时先解码
+        """
+        if not os.path.exists(media_path):
+            raise FileNotFoundError(f"{media_path} not found")
+        store_path = os.path.join(self.store_dir, f"{self._hash(media_path)}_{sample_rate}_{channels}.f32")
+        if not os.path.exists(store_path):
+            print(f"解码音频：{media_path}（{sample_rate}Hz，{channels}声道）")
+            part_path = store_path + ".part"
+            process = _decode_process(media_path, sample_rate, channels)
+            try:
+                with open(part_path, "wb") as f:
+                    for block in iter(lambda: process.stdout.read(1 << 20), b""):
+                        f.write(block)
+                if process.wait() != 0:
+                    raise RuntimeError(f"Failed to decode audio: {media_path}")
+                os.replace(part_path, store_path)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                process.stdout.close()
+                process.wait()
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            prune_cache(self.store_dir, self.max_bytes, keep=[store_path])
+        else:
+            touch(store_path)
+        return store_path
+
+    def get(self, media_path, sample_rate=16000, channels=1):
+        """
+        返回只读映射的float32数组：单声道为一维，多声道为(采样点数, 声道数)
+        """
+        store_path = self.path(media_path, sample_rate, channels)
+        if os.path.getsize(store_path) == 0:
+            audio = np.zeros(0, dtype=np.float32)
+        else:
+            audio = np.memmap(store_path, dtype=np.float32, mode="r")
+        if channels > 1:
+            audio = audio.reshape(-1, channels)
+        return audio
+
 def clear_folder(folder_path):
     for filename in os.listdir(folder_path):
         file_path = os.path.join(folder_path, filename)
@@ -3,13 +3,168 @@
 # pip install audio-separator[cpu]
 
 from audio_separator.separator import Separator  
+from utils import AudioStore, load_audio, content_hash, stream_audio, prune_cache, touch
+import numpy as np
+import soxr
 import logging
 import traceback
 import os
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import wave
 LOG_LE = logging.WARN
+# 记录模型目录中上次加载成功的模型，下次启动直接加载，不再逐个尝试
+MANIFEST_NAME = ".uvr_manifest.json"
+
+
+def to_pcm16(audio):
+    """
+    float32数组转成16位PCM字节
+    """
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def write_wav(path, audio, sample_rate):
+    """
+    把(采样点数, 声道数)的float32数组写成16位PCM wav
+    """
+    with wave.open(path, "wb") as f:
+        f.setnchannels(audio.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(to_pcm16(audio))
+
+
+def crossfade(tail, head):
+    """
+    线性交叉淡化：tail 逐渐淡出，head 逐渐淡入，两者长度相同
+    """
+    fade = np.linspace(0.0, 1.0, len(tail), dtype=np.float32)[:, None]
+    return tail * (1.0 - fade) + head * fade
+
+
+def background(generator, max_pending=2):
+    """
+    在后台线程里运行生成器，最多预先生成 max_pending 块。
+    下游（比如转录）处理当前块时，上游（比如分离）可以继续算下一块，内存占用仍然有上限
+    """
+    items = queue.Queue(max_pending)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for item in generator:
+                if not put(("item", item)):
+                    break
+            else:
+                put(("done", None))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            generator.close()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == "done":
+                break
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def to_asr_blocks(chunks, sample_rate, target_rate=16000):
+    """
+    把分离出的双声道块转成faster-whisper需要的16kHz单声道float32块，可以直接作为Transcribe的audio_binary_io
+    用流式重采样器跨块保留滤波器状态，结果与整段一次重采样一致，块与块之间没有接缝
+    """
+    resampler = soxr.ResampleStream(sample_rate, target_rate, 1, dtype="float32")
+    for chunk in chunks:
+        block = resampler.resample_chunk(np.ascontiguousarray(chunk.mean(axis=1), dtype=np.float32))
+        if len(block):
+            yield block
+    block = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+    if len(block):
+        yield block
+
+
+def detect_music(audio, sample_rate=16000, window=1.0, frame=0.025, low_energy_ratio=0.2, silence=1e-3,
+                 smooth=5, pad=0.5, min_duration=3.0, block_windows=600):
+    """
+    轻量的背景音乐检测，返回有背景音乐的区域 [(开始秒, 结束秒), ...]。
+    audio：16kHz单声道float32数组（可以是AudioStore的memmap，按 block_windows 个窗口分块读取，内存占用有上限）
+    判断依据是每 window 秒内低能量帧的比例：语音在音节和句子之间有大量停顿，低能量帧比例高；
+    音乐（包括压在人声下面的背景音乐）持续有能量，会把这些停顿填满，低能量帧比例低于 low_energy_ratio 即判为有音乐。
+    平均能量低于 silence 的窗口视为静音。判断结果做 smooth 个窗口的中值平滑，
+    区域两端各扩展 pad 秒，合并后短于 min_duration 秒的区域丢弃。
+    """
+    frame_size = int(frame * sample_rate)
+    frames_per_window = max(int(round(window / frame)), 1)
+    window_size = frame_size * frames_per_window
+    flags = []
+    for offset in range(0, len(audio), window_size * block_windows):
+        block = np.asarray(audio[offset:offset + window_size * block_windows], dtype=np.float32)
+        usable = len(block) // frame_size * frame_size
+        if usable == 0:
+            continue
+        rms = np.sqrt(np.mean(block[:usable].reshape(-1, frame_size) ** 2, axis=1))
+        for i in range(0, len(rms), frames_per_window):
+            r = rms[i:i + frames_per_window]
+            mean = r.mean()
+            flags.append(mean >= silence and np.mean(r < 0.5 * mean) < low_energy_ratio)
+    flags = np.array(flags, dtype=np.float32)
+    if len(flags) == 0:
+        return []
+    if smooth > 1:
+        padded = np.pad(flags, smooth // 2, mode="edge")
+        flags = np.median(np.lib.stride_tricks.sliding_window_view(padded, smooth), axis=1)[:len(flags)]
+    total = len(audio) / sample_rate
+    regions = []
+    start = None
+    for i, flag in enumerate(list(flags) + [0]):
+        if flag and start is None:
+            start = i
+        elif not flag and start is not None:
+            s, e = max(start * window - pad, 0.0), min(i * window + pad, total)
+            if regions and s <= regions[-1][1]:
+                regions[-1] = (regions[-1][0], e)
+            else:
+                regions.append((s, e))
+            start = None
+    return [(s, e) for s, e in regions if e - s >= min_duration]
+
 
 class UVR_Client:
-    def __init__(self,model_file_dir="./models/uvr5_weights",output_dir='./temp',sample_rate=44000) -> None:
+    def __init__(self,model_file_dir="./models/uvr5_weights",output_dir='./temp',sample_rate=44000,cache_dir="./cache/uvr",
+                 cache_max_bytes=20 << 30) -> None:
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.manifest_path = os.path.join(model_file_dir, MANIFEST_NAME)
+        # 分离结果缓存：按(内容哈希, 模型名)保存分离出的音轨，同一个文件不再重复分离
+        # 总大小超过 cache_max_bytes 时按最近使用时间淘汰旧的结果（None 表示不限制）
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # (路径, 大小, 修改时间) -> 内容哈希
+        self.hashes = {}
+        self.model_name = None
         try:
             print(f"[INFO] 初始化UVR客户端，模型目录: {model_file_dir}")
             
@@ -54,16 +209,27 @@ class UVR_Client:
             else:
                 print(f"[INFO] 找到本地模型文件: {local_models}")
             
-            # 尝试加载模型，优先使用本地文件
+            # 尝试加载模型，优先使用清单中记录的上次加载成功的模型，其次是本地文件
             model_loaded = False
+            manifest_model = self._read_manifest()
+            if manifest_model:
+                try:
+                    print(f"[INFO] 尝试加载上次使用的模型: {manifest_model}")
+                    self.model.load_model(manifest_model)
+                    print(f"[INFO] 模型加载成功: {manifest_model}")
+                    self.model_name = manifest_model
+                    model_loaded = True
+                except Exception as e:
+                    print(f"[WARNING] 上次使用的模型 {manifest_model} 加载失败: {str(e)}")
             
-            # 首先尝试加载本地模型文件
-            if local_models:
+            # 其次尝试加载本地模型文件
+            if local_models and not model_loaded:
                 for local_model in local_models:
                     try:
                         print(f"[INFO] 尝试加载本地模型: {local_model}")
                         self.model.load_model(local_model)
                         print(f"[INFO] 本地模型加载成功: {local_model}")
+                        self.model_name = local_model
                         model_loaded = True
                         break
                     except Exception as e:
@@ -78,6 +244,7 @@ class UVR_Client:
                         print(f"[INFO] 尝试加载默认模型: {default_model}")
                         self.model.load_model(default_model)
                         print(f"[INFO] 默认模型加载成功: {default_model}")
+                        self.model_name = default_model
                         model_loaded = True
                         break
                     except Exception as e:
@@ -86,6 +253,7 @@ class UVR_Client:
             
             if not model_loaded:
                 raise RuntimeError("所有模型加载失败，请检查audio-separator版本或手动下载模型文件")
+            self._write_manifest()
             
         except Exception as e:
             error_msg = f"UVR客户端初始化失败: {str(e)}"
@@ -107,6 +275,8 @@ class UVR_Client:
         try:
             print(f"[INFO] 切换模型: {model_name}")
             self.model.load_model(model_name)
+            self.model_name = model_name
+            self._write_manifest()
             print(f"[INFO] 模型切换成功: {model_name}")
         except Exception as e:
             error_msg = f"模型切换失败: {str(e)}"
@@ -122,7 +292,43 @@ class UVR_Client:
             
             raise e
 
+    def _read_manifest(self):
+        """
+        返回清单中记录的模型名，没有清单或清单损坏时返回None
+        """
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("model")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _write_manifest(self):
+        try:
+            temp_path = self.manifest_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"model": self.model_name}, f, ensure_ascii=False)
+            os.replace(temp_path, self.manifest_path)
+        except OSError as e:
+            print(f"[WARNING] 模型清单写入失败: {str(e)}")
+
+    def _hash(self, audio):
+        stat = os.stat(audio)
+        key = (os.path.abspath(audio), stat.st_size, stat.st_mtime)
+        if key not in self.hashes:
+            self.hashes[key] = content_hash(audio)
+        return self.hashes[key]
+
+    def cache_key(self, audio):
+        """
+        分离结果缓存的key：音频内容哈希 + 模型名
+        """
+        return f"{self._hash(audio)}_{self.model_name}"
+
     def infer(self,audio="E:\\audio_AI\\audio\\test\\感受孤独.flac"):
+        """
+        分离整个文件，返回 separate 输出的两个音轨的绝对路径（位于缓存目录）
+        同一个文件用同一个模型分离过时直接返回缓存的结果
+        """
         try:
             print(f"[INFO] 开始分离音频: {audio}")
             
@@ -130,7 +336,26 @@ class UVR_Client:
             if not os.path.exists(audio):
                 raise FileNotFoundError(f"音频文件不存在: {audio}")
             
-            primary_stem_output_path, secondary_stem_output_path = self.model.separate(audio)
+            cache_dir = os.path.join(self.cache_dir, self.cache_key(audio))
+            index_path = os.path.join(cache_dir, "outputs.json")
+            if os.path.exists(index_path):
+                with open(index_path, "r", encoding="utf-8") as f:
+                    output_files = [os.path.abspath(os.path.join(cache_dir, name)) for name in json.load(f)]
+                print(f"[INFO] 命中分离缓存: {cache_dir}")
+                touch(cache_dir)
+                return tuple(output_files)
+            
+            output_files = self.model.separate(audio)
+            # 把分离结果移到缓存目录（近乎静音的音轨模型不会写出文件）
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in output_files:
+                if os.path.exists(os.path.join(self.output_dir, name)):
+                    shutil.move(os.path.join(self.output_dir, name), os.path.join(cache_dir, name))
+            with open(index_path, "w", encoding="utf-8") as f:
+                json.dump(list(output_files), f, ensure_ascii=False)
+            prune_cache(self.cache_dir, self.cache_max_bytes, keep=[cache_dir])
+            primary_stem_output_path, secondary_stem_output_path = [
+                os.path.abspath(os.path.join(cache_dir, name)) for name in output_files]
             print(f"[INFO] 音频分离完成")
             print(f"[INFO] 主音轨输出: {primary_stem_output_path}")
             print(f"[INFO] 副音轨输出: {secondary_stem_output_path}")
@@ -156,6 +381,184 @@ class UVR_Client:
             
             raise e
 
+    def chunked_cache_path(self, audio, window, overlap, stem, gate):
+        """
+        分段分离结果在缓存目录中的路径，分段参数不同的结果分别缓存
+        """
+        name = f"{self.cache_key(audio)}_chunked_{self.sample_rate}_{window}_{overlap}_{stem}{'_gate' if gate else ''}.wav"
+        return os.path.abspath(os.path.join(self.cache_dir, name))
+
+    def _separate_window(self, audio, work_dir, index, stem=1):
+        """
+        分离一个窗口：写成临时wav交给模型，读回指定音轨后删除所有中间文件
+        返回与输入等长的(采样点数, 2) float32数组
+        """
+        window_path = os.path.join(work_dir, f"window_{index:05d}.wav")
+        write_wav(window_path, audio, self.sample_rate)
+        try:
+            output_files = self.model.separate(window_path)
+        finally:
+            os.remove(window_path)
+        output_files = [os.path.join(self.output_dir, f) for f in output_files]
+        try:
+            # 近乎静音的音轨模型不会写出文件，按静音处理
+            if os.path.exists(output_files[stem]):
+                result = np.array(load_audio(output_files[stem], self.sample_rate, 2))
+            else:
+                result = np.zeros((0, 2), dtype=np.float32)
+        finally:
+            for f in output_files:
+                if os.path.exists(f):
+                    os.remove(f)
+        if len(result) < len(audio):
+            result = np.concatenate([result, np.zeros((len(audio) - len(result), 2), dtype=np.float32)])
+        return result[:len(audio)]
+
+    def _separate_range(self, data, start, end, work_dir, size, fade, stem):
+        """
+        分离 data[start:end]：按重叠窗口依次送入模型，重叠部分交叉淡化后逐块 yield
+        yield 的总长度恰好是 end - start
+        """
+        tail = None
+        # 已经 yield 到的位置，超出 end 的部分截掉，保证输出与输入对齐
+        pos = start
+        while start < end:
+            stop = min(start + size, end)
+            last = stop >= end
+            result = self._separate_window(data[start:stop], work_dir, start, stem)
+            if tail is not None:
+                result[:len(tail)] = crossfade(tail, result[:len(tail)])
+            # 窗口末尾的重叠部分留给下一个窗口交叉淡化
+            keep = len(result) if last else len(result) - fade
+            chunk, tail = result[:keep][:end - pos], result[keep:]
+            print(f"[INFO] 已分离 {stop / self.sample_rate:.1f}/{len(data) / self.sample_rate:.1f} 秒")
+            yield chunk
+            pos += len(chunk)
+            if last:
+                break
+            start += size - fade
+
+    def _splice(self, chunks, data, start, end, edge):
+        """
+        把分离出的区域接回原始音频：区域两端 edge 个采样点内从原始音频渐变到分离结果，避免接缝处突变
+        （区域在文件开头或结尾时该端不渐变）
+        """
+        pos = start
+        for chunk in chunks:
+            t = np.arange(pos, pos + len(chunk))
+            weight = np.ones(len(chunk), dtype=np.float32)
+            if start > 0:
+                weight = np.minimum(weight, (t - start + 1) / edge)
+            if end < len(data):
+                weight = np.minimum(weight, (end - t) / edge)
+            weight = np.clip(weight, 0.0, 1.0)
+            if (weight < 1).any():
+                weight = weight[:, None].astype(np.float32)
+                chunk = np.asarray(data[pos:pos + len(chunk)]) * (1 - weight) + chunk * weight
+            yield chunk
+            pos += len(chunk)
+
+    def separate_stream(self, audio, window=60, overlap=2, output_path=None, audio_store=None, stem=1,
+                        gate=False, edge=0.2):
+        """
+        分段分离：按 window 秒的窗口（相邻窗口重叠 overlap 秒）依次送入模型，重叠部分交叉淡化后拼接。
+        分离出的音轨（stem 为 separate 返回值的下标，默认与 infer 的副音轨一致）逐块追加写入 output_path（wav），
+        同时逐块 yield 出来（float32，(采样点数, 2)），下游不必等整个文件分离完。
+        完整分离后结果保存到缓存目录（output_path 为None时直接写在缓存目录）。
+        输入从解码音频存储中映射读取，内存占用只和窗口长度有关，与音频总时长无关。
+        gate=True 时先用 detect_music 找出有背景音乐的区域，只分离这些区域，其余部分直接使用原始音频，
+        区域两端在 edge 秒内渐变拼接。
+        """
+        if not os.path.exists(audio):
+            raise FileNotFoundError(f"音频文件不存在: {audio}")
+        size = int(window * self.sample_rate)
+        fade = int(overlap * self.sample_rate)
+        if fade * 2 >= size:
+            raise ValueError("overlap 必须小于 window 的一半")
+        audio_store = audio_store or AudioStore()
+        data = audio_store.get(audio, self.sample_rate, 2)
+        total = len(data)
+        cache_path = self.chunked_cache_path(audio, window, overlap, stem, gate)
+        output_path = output_path or cache_path
+        part_path = output_path + ".part"
+        print(f"[INFO] 开始分段分离音频: {audio}（窗口 {window} 秒，重叠 {overlap} 秒）")
+        regions = [(0, total)]
+        if gate:
+            regions = [(int(s * self.sample_rate), min(int(e * self.sample_rate), total))
+                       for s, e in detect_music(audio_store.get(audio, 16000, 1))]
+            music = sum(e - s for s, e in regions)
+            print(f"[INFO] 检测到 {len(regions)} 段背景音乐，共 {music / self.sample_rate:.1f}/{total / self.sample_rate:.1f} 秒需要分离")
+        work_dir = tempfile.mkdtemp(dir=self.output_dir)
+        try:
+            with wave.open(part_path, "wb") as out:
+                out.setnchannels(2)
+                out.setsampwidth(2)
+                out.setframerate(self.sample_rate)
+                pos = 0
+                for start, end in regions + [(total, total)]:
+                    # 没有背景音乐的部分直接使用原始音频
+                    while pos < start:
+                        chunk = np.array(data[pos:min(pos + size, start)])
+                        out.writeframes(to_pcm16(chunk))
+                        yield chunk
+                        pos += len(chunk)
+                    if start >= end:
+                        continue
+                    chunks = self._separate_range(data, start, end, work_dir, size, fade, stem)
+                    if gate:
+                        chunks = self._splice(chunks, data, start, end, max(int(edge * self.sample_rate), 1))
+                    for chunk in chunks:
+                        out.writeframes(to_pcm16(chunk))
+                        yield chunk
+                        pos += len(chunk)
+            os.replace(part_path, output_path)
+            if output_path != cache_path:
+                shutil.copyfile(output_path, cache_path)
+            prune_cache(self.cache_dir, self.cache_max_bytes, keep=[cache_path])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        print(f"[INFO] 分段分离完成，输出: {output_path}")
+
+    def infer_chunked(self, audio, window=60, overlap=2, output_path=None, audio_store=None, stem=1, gate=False):
+        """
+        分段分离整个文件，返回输出wav的路径（output_path 为None时为缓存目录中的绝对路径）；内存占用只和窗口长度有关
+        gate=True 时只分离有背景音乐的区域
+        """
+        try:
+            cache_path = self.chunked_cache_path(audio, window, overlap, stem, gate)
+            if os.path.exists(cache_path):
+                print(f"[INFO] 命中分离缓存: {cache_path}")
+                touch(cache_path)
+                if output_path is None:
+                    return cache_path
+                shutil.copyfile(cache_path, output_path)
+                return output_path
+            for _ in self.separate_stream(audio, window, overlap, output_path, audio_store, stem, gate):
+                pass
+            return output_path or cache_path
+        except Exception as e:
+            print(f"[ERROR] 分段分离失败: {str(e)}")
+            print(f"[ERROR] 详细错误信息:")
+            print(traceback.format_exc())
+            raise e
+
+    def asr_blocks(self, audio, window=60, overlap=2, output_path=None, audio_store=None, stem=1, max_pending=2,
+                   gate=False):
+        """
+        边分离边转录：返回16kHz单声道float32块的生成器，直接作为Transcribe.run/stream的audio_binary_io。
+        分离在后台线程中进行，最多领先转录 max_pending 个窗口，分离结果同时写入 output_path
+        命中分离缓存时直接从缓存文件解码
+        """
+        cache_path = self.chunked_cache_path(audio, window, overlap, stem, gate)
+        if os.path.exists(cache_path):
+            print(f"[INFO] 命中分离缓存: {cache_path}")
+            touch(cache_path)
+            return stream_audio(cache_path)
+        chunks = background(self.separate_stream(audio, window, overlap, output_path, audio_store, stem, gate), max_pending)
+        return to_asr_blocks(chunks, self.sample_rate)
+
 
 if __name__ == "__main__":
     uvr = UVR_Client()
@@ -7,11 +7,13 @@ import base64
 import io
 import ffmpeg
 from translation import GPT,Baidu,Tencent,translation
-from utils import extract_audio,merge_subtitles_to_video,clear_folder,import_config_file
+from utils import extract_audio,merge_subtitles_to_video,clear_folder,import_config_file,AudioStore
 from uvr import UVR_Client
 
 # 临时文件存放地址
 TEMP = "./temp"
+# 解码后音频的共享存储，同一个媒体只解码一次
+audio_store = AudioStore()
 
 # def import_config_file(file):
 #     '''
@@ -337,7 +339,7 @@ def web_page():
 
         with st.spinner('字幕生成中。。。'):
             srt,ass = st.session_state.transcribe.run(file_name = input_audio,
-                                                      audio_binary_io = input_audio,
+                                                      audio_binary_io = audio_store.get(input_audio),
                                                       language=st.session_state.language,
                                                       is_vad_filter = st.session_state.is_vad_filter,
                                                       min_silence_duration_ms = st.session_state.min_silence_duration_ms,